@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import uuid
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db.session import init_db
+from db.session import SessionLocal
+from db.models import Email, Attachment
+from db.bulk_writer import Bulk_writer
+
+
+def make_records(count, body_size, prefix):
+
+    records = []
+
+    for i in range(count):
+
+        email_id = f"<{prefix}-{i}@bench.local>"
+
+        email_row = {
+            "id": email_id,
+            "thread_id": email_id,
+            "references": [],
+            "in_reply_to": "",
+            "sender": "bench@bench.local",
+            "recipients": ["rcpt@bench.local"],
+            "date": datetime.utcnow(),
+            "subject": f"benchmark email {i}",
+            "body": "x" * body_size,
+            "is_embedded": True
+        }
+
+        attachment_rows = [{
+            "id": str(uuid.uuid4()),
+            "email_id": email_id,
+            "filename": "notes.txt",
+            "mime_type": "text/plain",
+            "extension": ".txt",
+            "size": body_size,
+            "text_content": "y" * body_size
+        }]
+
+        records.append((email_row, attachment_rows))
+
+    return records
+
+
+def run_row_by_row(records, batch_size=5):
+
+    # the loaders' previous behaviour: SELECT per message, ORM add, commit every 5 rows
+    session = SessionLocal()
+    batch_counter = 0
+
+    for email_row, attachment_rows in records:
+
+        if session.query(Email).filter_by(id=email_row["id"]).first():
+            continue
+
+        session.add(Email(**email_row))
+        for row in attachment_rows:
+            session.add(Attachment(**row))
+
+        batch_counter += 1
+        if batch_counter >= batch_size:
+            session.commit()
+            batch_counter = 0
+
+    session.commit()
+    session.close()
+
+
+def run_bulk(records, batch_size=1000):
+
+    session = SessionLocal()
+    writer = Bulk_writer(session, max_rows=batch_size)
+
+    for email_row, attachment_rows in records:
+        if writer.add(email_row, attachment_rows):
+            writer.flush()
+            session.commit()
+
+    writer.flush()
+    session.commit()
+    session.close()
+
+
+def cleanup(prefix):
+
+    session = SessionLocal()
+    pattern = f"<{prefix}-%"
+    session.query(Attachment).filter(Attachment.email_id.like(pattern)).delete(synchronize_session=False)
+    session.query(Email).filter(Email.id.like(pattern)).delete(synchronize_session=False)
+    session.commit()
+    session.close()
+
+
+def measure(name, func, count, body_size):
+
+    prefix = f"bench-{uuid.uuid4().hex[:8]}"
+    records = make_records(count, body_size, prefix)
+
+    try:
+        start = time.perf_counter()
+        func(records)
+        elapsed = time.perf_counter() - start
+    finally:
+        cleanup(prefix)
+
+    print(f"  {name:<12}: {count / elapsed:10,.0f} rows/sec ({elapsed:.2f} s)")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare row-by-row and bulk email inserts.")
+    parser.add_argument("--count", type=int, default=5000, help="Number of emails to insert.")
+    parser.add_argument("--body_size", type=int, default=2000, help="Characters per body and attachment text.")
+    args = parser.parse_args()
+
+    init_db()
+
+    print(f"Inserting {args.count} emails with one attachment each:")
+    measure("row-by-row", run_row_by_row, args.count, args.body_size)
+    measure("bulk", run_bulk, args.count, args.body_size)
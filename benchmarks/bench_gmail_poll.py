@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from google.auth.credentials import AnonymousCredentials
+
+import config
+from fake_gmail_server import Fake_gmail_server
+
+
+def poll_sequential(gmail, messages):
+    """ One HTTP round trip per metadata, full message and attachment fetch. """
+
+    service = gmail.service.users().messages()
+
+    for msg in messages:
+        service.get(userId='me', id=msg['id'], format='metadata').execute()
+        full = service.get(userId='me', id=msg['id'], format='full').execute()
+        for part in full["payload"].get("parts", []):
+            attachment_id = part.get("body", {}).get("attachmentId")
+            if part.get("filename") and attachment_id:
+                service.attachments().get(userId='me', messageId=msg['id'], id=attachment_id).execute()
+
+
+def poll_batched(gmail, messages):
+
+    header_map, _ = gmail.get_msg_header(messages)
+    full_messages = gmail.fetch_messages(list(header_map), "full")
+    gmail.fetch_attachments(full_messages.values())
+
+
+def measure(name, func, fake, gmail, messages):
+
+    fake.http_calls = 0
+    start = time.perf_counter()
+    func(gmail, messages)
+    elapsed = time.perf_counter() - start
+
+    print(f"  {name:<10}: {elapsed:8.2f} s  {fake.http_calls:6} HTTP calls")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare sequential and batched Gmail fetches against a local fake Gmail API.")
+    parser.add_argument("--messages", type=int, default=1000, help="Messages in the poll.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated round-trip time per HTTP call in seconds.")
+    parser.add_argument("--skip_sequential", action="store_true", help="Only run the batched fetch.")
+    args = parser.parse_args()
+
+    fake = Fake_gmail_server(messages=args.messages, latency=args.latency).start()
+    config.gmail_api_root = fake.root_url
+
+    # imported after the API root is set
+    from services.email_loader_gmail import Email_loader_Gmail
+
+    gmail = Email_loader_Gmail(credentials=AnonymousCredentials())
+    messages = gmail.service.users().messages().list(userId='me', maxResults=args.messages).execute()["messages"]
+
+    print(f"Fetching {len(messages)} messages, {args.latency * 1000:.0f} ms per HTTP call:")
+
+    if not args.skip_sequential:
+        measure("sequential", poll_sequential, fake, gmail, messages)
+    measure("batched", poll_batched, fake, gmail, messages)
+
+    fake.stop()
@@ -0,0 +1,68 @@
+import os
+import sys
+import glob
+import time
+import difflib
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.email_loader import Email_loader
+from services.email_loader import lxml_html
+
+
+def load_corpus(corpus_dir):
+
+    documents = []
+
+    for path in sorted(glob.glob(os.path.join(corpus_dir, "**", "*.htm*"), recursive=True)):
+        with open(path, "rb") as f:
+            documents.append(f.read().decode("utf-8", errors="ignore"))
+
+    return documents
+
+
+def measure(name, func, documents, rounds):
+
+    outputs = []
+    start = time.perf_counter()
+
+    for _ in range(rounds):
+        outputs = []
+        for html_text in documents:
+            status, output = func(html_text)
+            outputs.append(output if status else "")
+
+    elapsed = time.perf_counter() - start
+    total_mb = sum(len(d) for d in documents) * rounds / (1024 * 1024)
+
+    print(f"  {name:<10}: {elapsed:8.2f} s  {len(documents) * rounds / elapsed:10,.0f} docs/sec  {total_mb / elapsed:8.2f} MB/sec")
+
+    return outputs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the html2text and lxml HTML to text converters.")
+    parser.add_argument("--corpus", required=True, metavar="DIR", help="Directory with .html files (e.g. saved newsletters).")
+    parser.add_argument("--rounds", type=int, default=3, help="Number of passes over the corpus.")
+    args = parser.parse_args()
+
+    if lxml_html is None:
+        print("Error: lxml is not installed")
+        sys.exit(1)
+
+    documents = load_corpus(args.corpus)
+    if not documents:
+        print(f"Error: no .html files found in {args.corpus}")
+        sys.exit(1)
+
+    loader = Email_loader()
+
+    print(f"Converting {len(documents)} HTML documents, {args.rounds} rounds:")
+    slow = measure("html2text", loader.html_to_text_html2text, documents, args.rounds)
+    fast = measure("lxml", loader.html_to_text_lxml, documents, args.rounds)
+
+    # word-level similarity, layout differences (list bullets, blank lines) do not matter for embedding
+    ratios = [difflib.SequenceMatcher(None, a.split(), b.split()).ratio() for a, b in zip(slow, fast)]
+    print(f"\nMean word similarity of outputs: {sum(ratios) / len(ratios):.3f} (min {min(ratios):.3f})")
@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.email_loader_mbox import Email_loader_mbox
+
+
+def scan(path):
+    """ Split the mailbox into messages and read their headers, the work done before any full parse. """
+
+    loader = Email_loader_mbox(path)
+    loader.known_ids = set()
+
+    messages = 0
+    total_bytes = 0
+    start = time.perf_counter()
+
+    if loader.compression:
+        with loader._open_stream() as stream:
+            for _, _, data in loader._iter_stream_messages(stream):
+                loader._prefilter(data, data, 0, len(data))
+                messages += 1
+                total_bytes += len(data)
+    else:
+        mm = loader._map_mbox()
+        if mm is not None:
+            view = memoryview(mm)
+            for start_offset, end in loader._iter_mbox_ranges(mm, 0, False):
+                loader._prefilter(mm, view[start_offset:end], start_offset, end)
+                messages += 1
+                total_bytes += end - start_offset
+            view.release()
+            mm.close()
+
+    return messages, total_bytes, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare mbox scan throughput of plain and compressed mailboxes.")
+    parser.add_argument("paths", nargs="+", metavar="MBOX", help="Mailbox files, e.g. mail.mbox mail.mbox.gz mail.mbox.zst")
+    args = parser.parse_args()
+
+    print(f"{'file':<40} {'messages':>10} {'seconds':>9} {'MB/sec':>9}")
+
+    for path in args.paths:
+        messages, total_bytes, elapsed = scan(path)
+        print(f"{os.path.basename(path):<40} {messages:>10,} {elapsed:>9.2f} {total_bytes / (1024 * 1024) / elapsed:>9.1f}")
@@ -0,0 +1,276 @@
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from base64 import urlsafe_b64encode
+from email import message_from_bytes
+from email.message import EmailMessage
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def b64(data):
+
+    return urlsafe_b64encode(data).decode("ascii")
+
+
+class Fake_gmail_server():
+    """ In-memory stand-in for the Gmail REST API (profile, history, messages list/get, attachments get and batch calls). """
+
+    def __init__(self, messages=1000, attachment_every=5, latency=0.0, port=0):
+
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.http_calls = 0
+        self.api_calls = 0
+
+        self.messages = {}
+        self.attachments = {}
+        self.order = []
+
+        # every added message bumps the mailbox history id; ids below history_floor have expired
+        self.history_id = 1000
+        self.history_floor = 0
+
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+        for i in range(messages):
+            self.add_message(i, start + timedelta(minutes=i), with_attachment=attachment_every and i % attachment_every == 0)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+
+    @property
+    def root_url(self):
+
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+
+
+    def start(self):
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+    def add_message(self, i, date, with_attachment=False):
+
+        msg = EmailMessage()
+        msg["Message-ID"] = f"<fake-{i}@example.com>"
+        msg["From"] = f"Sender {i % 7} <sender{i % 7}@example.com>"
+        msg["To"] = "me@example.com"
+        msg["Subject"] = f"Fake message {i}"
+        msg["Date"] = format_datetime(date)
+        if i % 3:
+            msg["In-Reply-To"] = f"<fake-{i - i % 3}@example.com>"
+            msg["References"] = f"<fake-{i - i % 3}@example.com>"
+        msg.set_content(f"Body of fake message {i}.\n" + "lorem ipsum " * random.randint(10, 200))
+
+        if with_attachment:
+            msg.add_attachment(f"attachment text {i}\n".encode() * 50, maintype="text", subtype="plain", filename=f"notes-{i}.txt")
+
+        gmail_id = f"{i:016x}"
+        raw = msg.as_bytes()
+
+        with self.lock:
+            self.history_id += 1
+            self.messages[gmail_id] = {
+                "id": gmail_id,
+                "threadId": f"{i - i % 3:016x}",
+                "labelIds": ["INBOX"],
+                "internalDate": str(int(date.timestamp() * 1000)),
+                "historyId": self.history_id,
+                "raw": raw,
+            }
+            self.order.append(gmail_id)
+
+        return gmail_id
+
+
+    def _payload(self, gmail_id, part, with_body):
+
+        headers = [{"name": k, "value": str(v)} for k, v in part.items()]
+        payload = {"mimeType": part.get_content_type(), "filename": part.get_filename() or "", "headers": headers, "body": {"size": 0}}
+
+        if not with_body:
+            return payload
+
+        if part.is_multipart():
+            payload["parts"] = [self._payload(gmail_id, p, True) for p in part.get_payload()]
+            return payload
+
+        data = part.get_payload(decode=True) or b""
+        payload["body"]["size"] = len(data)
+
+        if part.get_filename():
+            attachment_id = f"att-{gmail_id}-{len(self.attachments)}"
+            self.attachments.setdefault((gmail_id, attachment_id), data)
+            payload["body"]["attachmentId"] = attachment_id
+        else:
+            payload["body"]["data"] = b64(data)
+
+        return payload
+
+
+    def get_message(self, gmail_id, message_format):
+
+        stored = self.messages[gmail_id]
+        result = {k: stored[k] for k in ("id", "threadId", "labelIds", "internalDate")}
+
+        if message_format == "raw":
+            result["raw"] = b64(stored["raw"])
+        else:
+            message = message_from_bytes(stored["raw"])
+            with self.lock:
+                result["payload"] = self._payload(gmail_id, message, message_format == "full")
+
+        return result
+
+
+    def handle_api(self, method, path, query):
+        """ Answer one REST call. Returns (status, json body). """
+
+        with self.lock:
+            self.api_calls += 1
+
+        page_size = int(query.get("maxResults", ["100"])[0])
+        page_start = int(query.get("pageToken", ["0"])[0])
+
+        if path == "/gmail/v1/users/me/profile":
+            return 200, {"emailAddress": "me@example.com", "messagesTotal": len(self.order), "historyId": str(self.history_id)}
+
+        if path == "/gmail/v1/users/me/history":
+            start_history_id = int(query["startHistoryId"][0])
+            if start_history_id < self.history_floor:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            added = [self.messages[i] for i in self.order if self.messages[i]["historyId"] > start_history_id]
+            page = added[page_start:page_start + page_size]
+            result = {
+                "history": [{"id": str(m["historyId"]), "messagesAdded": [{"message": {"id": m["id"], "threadId": m["threadId"], "labelIds": m["labelIds"]}}]} for m in page],
+                "historyId": str(self.history_id),
+            }
+            if page_start + page_size < len(added):
+                result["nextPageToken"] = str(page_start + page_size)
+            return 200, result
+
+        if path == "/gmail/v1/users/me/messages":
+            ids = self.order[::-1]
+            page = ids[page_start:page_start + page_size]
+            result = {"messages": [{"id": i, "threadId": self.messages[i]["threadId"]} for i in page], "resultSizeEstimate": len(ids)}
+            if page_start + page_size < len(ids):
+                result["nextPageToken"] = str(page_start + page_size)
+            return 200, result
+
+        m = re.fullmatch(r"/gmail/v1/users/me/messages/([^/]+)/attachments/([^/]+)", path)
+        if m:
+            data = self.attachments.get((m.group(1), m.group(2)))
+            if data is None:
+                return 404, {"error": {"code": 404, "message": "Not Found"}}
+            return 200, {"size": len(data), "data": b64(data)}
+
+        m = re.fullmatch(r"/gmail/v1/users/me/messages/([^/]+)", path)
+        if m:
+            if m.group(1) not in self.messages:
+                return 404, {"error": {"code": 404, "message": "Not Found"}}
+            return 200, self.get_message(m.group(1), query.get("format", ["full"])[0])
+
+        return 404, {"error": {"code": 404, "message": f"Unknown path {path}"}}
+
+
+    def handle_batch(self, content_type, body):
+
+        container = message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        boundary = "batch_response_boundary"
+        out = []
+
+        for part in container.get_payload():
+
+            request_text = part.get_payload(decode=True) or part.get_payload().encode()
+            request_line = request_text.split(b"\n", 1)[0].decode().strip()
+            method, uri, _ = request_line.split(" ", 2)
+            url = urlparse(uri)
+
+            status, result = self.handle_api(method, url.path, parse_qs(url.query))
+
+            content_id = (part.get("Content-ID") or "").strip("<>")
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: application/json\r\n\r\n"
+                f"{json.dumps(result)}\r\n")
+
+        out.append(f"--{boundary}--\r\n")
+
+        return f"multipart/mixed; boundary={boundary}", "".join(out).encode()
+
+
+    def _make_handler(self):
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _count(self):
+                with server.lock:
+                    server.http_calls += 1
+                if server.latency:
+                    time.sleep(server.latency)
+
+            def do_GET(self):
+                self._count()
+                url = urlparse(self.path)
+                status, result = server.handle_api("GET", url.path, parse_qs(url.query))
+                self._reply(status, "application/json", json.dumps(result).encode())
+
+            def do_POST(self):
+                self._count()
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if urlparse(self.path).path != "/batch/gmail/v1":
+                    self._reply(404, "application/json", b"{}")
+                    return
+                content_type, payload = server.handle_batch(self.headers["Content-Type"], body)
+                self._reply(200, content_type, payload)
+
+        return Handler
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve a fake Gmail API for testing the Gmail loader (set config.gmail_api_root to its URL).")
+    parser.add_argument("--messages", type=int, default=1000, help="Number of generated messages.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated round-trip time per HTTP call in seconds.")
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+
+    fake = Fake_gmail_server(messages=args.messages, latency=args.latency, port=args.port).start()
+    print(f"Fake Gmail API with {args.messages} messages at {fake.root_url}")
+
+    try:
+        fake.thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
+        sys.exit(0)
@@ -1,3 +1,77 @@
 # config.py
 
 rag_search_url = "http://localhost:8000"
+
+# Email threads embedded concurrently, and the cap on requests to RAG-Search in flight across all of them
+embed_workers = 1
+rag_search_max_in_flight = 4
+
+# Characters shared by consecutive chunks of the local text splitter (services/text_splitter.py), LangChain's default
+split_chunk_overlap = 200
+
+# Local tokenizer.json per embedding or LLM model (services/token_counter.py, requires the optional tokenizers package),
+# relative to this directory. download_tokenizers.py fetches the listed ones. Token limits of models without a
+# tokenizer file are converted to characters with avg_chars_per_token
+tokenizer_files = {
+    "all-MiniLM-L6-v2"  : "tokenizers/all-MiniLM-L6-v2.json",
+    "all-MiniLM-L12-v2" : "tokenizers/all-MiniLM-L12-v2.json",
+    "bge-base-en-v1.5"  : "tokenizers/bge-base-en-v1.5.json",
+    "bge-large-en-v1.5" : "tokenizers/bge-large-en-v1.5.json",
+    "mxbai-embed-large" : "tokenizers/mxbai-embed-large.json",
+    "e5-base-v2"        : "tokenizers/e5-base-v2.json",
+    "e5-large-v2"       : "tokenizers/e5-large-v2.json",
+    "bge-m3"            : "tokenizers/bge-m3.json",
+    "nomic-embed-text"  : "tokenizers/nomic-embed-text.json",
+}
+avg_chars_per_token = 3.5
+
+# Pending threads loaded from the database per page by the embedding worker
+embed_page_size = 200
+
+# Embedding layout: 'thread' (one document per thread, summarized when long) or 'incremental' (one document per email)
+embed_mode = "thread"
+
+# Incremental mode: characters of the previous email prepended to each email as context, 0 to disable
+incremental_context_chars = 300
+
+# Incremental mode: rebuild a thread once the emails added, changed or removed since its last rebuild
+# exceed this fraction of the emails it had then
+incremental_drift_threshold = 1.0
+
+# Attachment text extraction (services/attachment_extractor.py)
+extraction_workers = 2
+extraction_max_input_bytes = 50 * 1024 * 1024
+extraction_max_pages = 200
+extraction_max_output_chars = 500000
+extraction_max_depth = 2
+extraction_spool_bytes = 8 * 1024 * 1024
+
+# HTML to text converter for bodies and HTML attachments: 'html2text' or 'lxml'
+html_converter = "html2text"
+
+# Keep raw attachment bytes in the database after deferred extraction finished
+keep_attachment_content = False
+
+# Gmail API root, point it at a local fake server for testing
+gmail_api_root = "https://gmail.googleapis.com/"
+
+# Sub-requests per Gmail batch HTTP call (the API allows at most 100) and batch calls in flight
+gmail_batch_size = 100
+gmail_batch_concurrency = 4
+
+# Gmail fetch mode: 'full' (metadata, full message and attachment calls) or 'raw' (one call per message, parsed like mbox)
+gmail_fetch_format = "full"
+
+# Refresh the Gmail OAuth access token when it expires within this many seconds
+gmail_token_refresh_margin = 300
+
+# Gmail per-user quota budget in units per second (the API allows 250)
+gmail_quota_units_per_second = 200
+
+# Gmail polling (services/poll_scheduler.py): delay after new mail, upper bound while quiet, growth per quiet poll
+poll_min_interval = 5
+poll_max_interval = 300
+poll_backoff = 2.0
+
+# Port of the Prometheus /metrics endpoint (services/metrics.py), None to disable
+metrics_port = None
@@ -0,0 +1,87 @@
+from sqlalchemy.dialects.postgresql import insert
+from db.models import Email, Attachment
+
+# PostgreSQL accepts at most 65535 bind parameters per statement
+MAX_BIND_PARAMS = 30000
+
+
+class Bulk_writer():
+    """ Buffer parsed emails and attachments and write them with multi-row INSERT ... ON CONFLICT statements. """
+
+    def __init__(self, session, max_rows=1000, max_bytes=8*1024*1024):
+
+        self.session = session
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+
+        self.emails = []
+        self.attachments = []
+        self.email_ids = set()
+        self.buffered_bytes = 0
+
+
+    def add(self, email_row, attachment_rows=()):
+        """ Buffer one email with its attachments. Returns True once the buffer should be flushed. """
+
+        if email_row["id"] in self.email_ids:
+            return self.is_full()
+
+        self.email_ids.add(email_row["id"])
+        self.emails.append(email_row)
+        self.buffered_bytes += len(email_row.get("body") or "")
+
+        for row in attachment_rows:
+            self.attachments.append(row)
+            self.buffered_bytes += len(row.get("text_content") or "")
+            self.buffered_bytes += len(row.get("content") or b"")
+
+        return self.is_full()
+
+
+    def contains(self, email_id):
+
+        return email_id in self.email_ids
+
+
+    def is_full(self):
+
+        # large bodies and attachment texts flush early, small rows batch up to max_rows
+        return len(self.emails) >= self.max_rows or self.buffered_bytes >= self.max_bytes
+
+
+    def flush(self):
+        """ Write the buffered rows in the current transaction; the caller commits. Returns the number of new emails. """
+
+        if not self.emails:
+            return 0
+
+        inserted = set()
+
+        for rows in self._split(self.emails):
+            stmt = insert(Email).values(rows).on_conflict_do_nothing(index_elements=["id"]).returning(Email.id)
+            inserted.update(row[0] for row in self.session.execute(stmt))
+
+        # attachments of emails that were already stored are dropped with them
+        attachments = [a for a in self.attachments if a["email_id"] in inserted]
+
+        for rows in self._split(attachments):
+            stmt = insert(Attachment).values(rows).on_conflict_do_nothing(index_elements=["id"])
+            self.session.execute(stmt)
+
+        self.emails = []
+        self.attachments = []
+        self.email_ids = set()
+        self.buffered_bytes = 0
+
+        return len(inserted)
+
+
+    def _split(self, rows):
+
+        if not rows:
+            return
+
+        step = max(1, MAX_BIND_PARAMS // len(rows[0]))
+
+        for i in range(0, len(rows), step):
+            yield rows[i:i + step]
@@ -1,6 +1,6 @@
 
-from sqlalchemy import Column, String, Text, DateTime, Boolean, ForeignKey, Integer, LargeBinary
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import Column, String, Text, DateTime, Boolean, ForeignKey, Integer, BigInteger, Float, LargeBinary
+from sqlalchemy.orm import declarative_base, relationship, deferred
 from sqlalchemy.dialects.postgresql import ARRAY
 
 Base = declarative_base()
@@ -20,6 +20,7 @@ class Email(Base):
     sender = Column(String, nullable=False)
     recipients = Column(ARRAY(String), nullable=False)
     is_embedded = Column(Boolean, default=False)
+    gmail_id = Column(String, index=True)
 
     attachments = relationship("Attachment", back_populates="email", cascade="all, delete-orphan")
 
@@ -35,5 +36,89 @@ class Attachment(Base):
     extension = Column(String)
     size = Column(Integer)
     text_content = Column(Text, nullable=True)
+    content_hash = Column(String(64), index=True)
+    extraction_status = Column(String, index=True)
+    content = deferred(Column(LargeBinary, nullable=True))
+    created_at = Column(DateTime)
 
     email = relationship("Email", back_populates="attachments")
+
+
+class MboxCheckpoint(Base):
+
+    __tablename__ = "mbox_checkpoints"
+
+    path = Column(String, primary_key=True, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    mtime = Column(Float, nullable=False)
+    inode = Column(BigInteger)
+    offset = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime)
+
+
+class MailFile(Base):
+
+    __tablename__ = "mail_files"
+
+    path = Column(Text, primary_key=True, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    mtime = Column(Float, nullable=False)
+    email_id = Column(String)
+
+
+class AttachmentText(Base):
+
+    __tablename__ = "attachment_texts"
+
+    content_hash = Column(String(64), primary_key=True, nullable=False)
+    extractor_version = Column(Integer, primary_key=True, nullable=False)
+    mime_type = Column(String)
+    text_content = Column(Text, nullable=False)
+    created_at = Column(DateTime)
+
+
+class SummaryCache(Base):
+
+    __tablename__ = "summary_cache"
+
+    content_hash = Column(String(64), primary_key=True, nullable=False)
+    llm_model = Column(String, primary_key=True, nullable=False)
+    prompt_version = Column(Integer, primary_key=True, nullable=False)
+    summary = Column(Text, nullable=False)
+    created_at = Column(DateTime)
+
+
+class ThreadEmbedding(Base):
+
+    __tablename__ = "thread_embeddings"
+
+    thread_id = Column(String, primary_key=True, nullable=False)
+    collection_name = Column(String, primary_key=True, nullable=False)
+    fingerprint = Column(String(64), nullable=False)
+    embed_model = Column(String)
+    llm_model = Column(String)
+    chunk_size = Column(Integer)
+    mode = Column(String)
+    base_email_count = Column(Integer)
+    drift_count = Column(Integer)
+    updated_at = Column(DateTime)
+
+
+class EmailEmbedding(Base):
+
+    __tablename__ = "email_embeddings"
+
+    email_id = Column(String, primary_key=True, nullable=False)
+    collection_name = Column(String, primary_key=True, nullable=False)
+    thread_id = Column(String, index=True, nullable=False)
+    fingerprint = Column(String(64), nullable=False)
+    updated_at = Column(DateTime)
+
+
+class SyncState(Base):
+
+    __tablename__ = "sync_state"
+
+    source = Column(String, primary_key=True, nullable=False)
+    history_id = Column(String)
+    updated_at = Column(DateTime)
@@ -0,0 +1,61 @@
+import os
+import sys
+import argparse
+import urllib.request
+
+import config
+
+# Hugging Face repository of each embedding model in config.tokenizer_files
+model_repos = {
+    "all-MiniLM-L6-v2"  : "sentence-transformers/all-MiniLM-L6-v2",
+    "all-MiniLM-L12-v2" : "sentence-transformers/all-MiniLM-L12-v2",
+    "bge-base-en-v1.5"  : "BAAI/bge-base-en-v1.5",
+    "bge-large-en-v1.5" : "BAAI/bge-large-en-v1.5",
+    "mxbai-embed-large" : "mixedbread-ai/mxbai-embed-large-v1",
+    "e5-base-v2"        : "intfloat/e5-base-v2",
+    "e5-large-v2"       : "intfloat/e5-large-v2",
+    "bge-m3"            : "BAAI/bge-m3",
+    "nomic-embed-text"  : "nomic-ai/nomic-embed-text-v1.5",
+}
+
+
+def download(model, path):
+
+    url = f"https://huggingface.co/{model_repos[model]}/resolve/main/tokenizer.json"
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    print(f"Downloading {url} -> {path}")
+    urllib.request.urlretrieve(url, path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Download the tokenizer.json files listed in config.tokenizer_files, for offline token counting.")
+    parser.add_argument("models", nargs="*", help="Models to download (default: all listed ones without a file yet).")
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.abspath(config.__file__))
+    failed = 0
+
+    for model in args.models or config.tokenizer_files:
+
+        path = config.tokenizer_files.get(model)
+        if not path or model not in model_repos:
+            print(f"[WARN] No tokenizer source known for {model}, add it to config.tokenizer_files and model_repos")
+            failed += 1
+            continue
+
+        if not os.path.isabs(path):
+            path = os.path.join(root, path)
+
+        if os.path.isfile(path) and not args.models:
+            continue
+
+        try:
+            download(model, path)
+        except Exception as e:
+            print(f"[ERROR] Cannot download the tokenizer of {model}: {e}")
+            failed += 1
+
+    sys.exit(1 if failed else 0)
@@ -4,21 +4,32 @@ import sys
 import threading
 import time
 import argparse
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
+
+import config
 
 from datetime import datetime
-from datetime import timezone
-from sqlalchemy import desc
+from datetime import timedelta
+from sqlalchemy import update, any_, bindparam, String
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import selectinload
 from db.session import init_db
 from db.session import SessionLocal
-from db.models import Email
+from db.models import Email, Attachment
 
 from services.email_loader_gmail import Email_loader_Gmail
 from services.email_loader_mbox import Email_loader_mbox
+from services.email_loader_maildir import Email_loader_maildir
 from services.rag_search_remote import load_model, create_collection
 from services.email_embedder_worker import embed_thread_start
+from services.email_embedder_worker import clear_collection_fingerprints
+from services.attachment_extraction_worker import extract_pending_attachments
+from services.poll_scheduler import Poll_scheduler
+from services.metrics import metrics
 
 
-def run_pipeline(source, mailbox, llm_model, embed_model, chunk_size, collection_name, dump_text_block):
+def run_pipeline(source, mailbox, follow, workers, since, until, from_filter, defer_extraction, attachment_wait, embed_workers, llm_model, embed_model, chunk_size, collection_name, dump_text_block, reembed=False):
 
     if os.path.exists(dump_text_block):
         os.remove(dump_text_block)
@@ -33,100 +44,250 @@ def run_pipeline(source, mailbox, llm_model, embed_model, chunk_size, collection
 
     create_collection(collection_name, embed_model)
 
+    # fingerprints outlive the collection, after it was dropped or recreated nothing would be embedded again
+    if reembed:
+        reset_embeddings(collection_name)
+
     if source == "gmail":
-        poll_t = threading.Thread(target=email_polling_worker, daemon=True)
+        poll_t = threading.Thread(target=email_polling_worker, args=(defer_extraction,), daemon=True)
         poll_t.start()
     elif source == "mbox":
-        poll_t = threading.Thread(target=email_loader_worker, args=(mailbox,), daemon=True)
+        poll_t = threading.Thread(target=email_loader_worker, args=(mailbox, follow, workers, since, until, from_filter, defer_extraction), daemon=True)
+        poll_t.start()
+    elif source == "maildir":
+        poll_t = threading.Thread(target=maildir_loader_worker, args=(mailbox, workers, defer_extraction), daemon=True)
         poll_t.start()
     else:
         print(f"Error: invalid source {source}")
         sys.exit(1)
 
-    embed_t = threading.Thread(target=embedding_worker, args=(llm_model, embed_model, collection_name, chunk_size, dump_text_block), daemon=True)
+    extract_t = threading.Thread(target=attachment_extraction_worker, daemon=True)
+    extract_t.start()
+
+    embed_t = threading.Thread(target=embedding_worker, args=(llm_model, embed_model, collection_name, chunk_size, dump_text_block, attachment_wait, embed_workers), daemon=True)
     embed_t.start()
 
     poll_t.join()
+    extract_t.join()
     embed_t.join()
 
 
-def email_polling_worker():
+def email_polling_worker(defer_extraction):
+
+    gmail = Email_loader_Gmail(defer_extraction=defer_extraction)
+    scheduler = Poll_scheduler()
 
     while True:
 
-        session = SessionLocal()
-        latest_email = session.query(Email).order_by(desc(Email.date)).first()
-        session.close()
+        print(f"[{datetime.now()}] Fetching new emails from Gmail")
+
+        new_messages = 0
+
+        try:
+            new_messages = gmail.sync()
+        except Exception as e:
+            print(f"[ERROR] Gmail sync failed: {e}")
+
+        # polls quickly while mail is arriving, backs off while the mailbox is quiet
+        interval = scheduler.next_interval(new_messages)
+        print(f"[{datetime.now()}] Next Gmail poll in {interval:.0f} seconds")
+
+        time.sleep(interval)
+
+
+def email_loader_worker(mailbox, follow, workers, since, until, from_filter, defer_extraction):
+
+    unix = Email_loader_mbox(mailbox,
+                             workers=workers,
+                             since=since,
+                             until=until,
+                             from_filter=from_filter,
+                             defer_extraction=defer_extraction)
+
+    if follow:
+        unix.follow()
+    else:
+        unix.load_emails()
 
-        last_seen = None
-        if latest_email and latest_email.date:
-            last_seen = latest_email.date
-            if last_seen.tzinfo is None:
-                last_seen = last_seen.replace(tzinfo=timezone.utc)
 
-        print(f"[{datetime.now()}] Fetching emails since: {last_seen}")
+def maildir_loader_worker(mail_dir, workers, defer_extraction):
 
-        gmail = Email_loader_Gmail()
-        gmail.load_emails(since=last_seen, max_results=1000)
+    loader = Email_loader_maildir(mail_dir,
+                                  workers=workers,
+                                  defer_extraction=defer_extraction)
+    loader.load_emails()
 
-        time.sleep(20)
 
+def attachment_extraction_worker():
+
+    while True:
 
-def email_loader_worker(mailbox):
+        # keep draining while there is a backlog, otherwise check again later
+        if not extract_pending_attachments():
+            time.sleep(5)
 
-    unix = Email_loader_mbox(mailbox)
-    unix.load_emails()
 
+def embedding_worker(llm_model, embed_model, collection_name, chunk_size, dump_text_block, attachment_wait, embed_workers):
 
-def embedding_worker(llm_model, embed_model, collection_name, chunk_size, dump_text_block):
+    executor = ThreadPoolExecutor(max_workers=max(1, embed_workers))
 
     while True:
 
-        session = SessionLocal()
+        after_thread_id = None
+        thread_count = 0
+
+        while True:
+
+            threads = load_pending_threads(attachment_wait, after_thread_id, config.embed_page_size)
+            if not threads:
+                break
+
+            after_thread_id = threads[-1][0]
+            thread_count += len(threads)
+
+            # every thread id appears once per page and pages are processed one after another,
+            # so no two workers ever embed the same thread
+            results = list(executor.map(embed_pending_thread,
+                                        threads,
+                                        repeat(llm_model),
+                                        repeat(embed_model),
+                                        repeat(collection_name),
+                                        repeat(chunk_size),
+                                        repeat(dump_text_block)))
+
+            mark_threads_embedded([emails for (_, emails), status in zip(threads, results) if status])
+
+        if not thread_count:
+            print("[INFO] No pending email threads found for embedding.")
+
+        time.sleep(10)
+
+
+def load_pending_threads(attachment_wait, after_thread_id, page_size):
+    """ Next page of threads with emails that are not embedded, as [(thread_id, emails)]. Loaded with three queries per page. """
+
+    session = SessionLocal()
+
+    try:
 
         # Get thread_ids where at least one email is not embedded
-        thread_ids = session.query(Email.thread_id).filter(Email.is_embedded == False).distinct().all()
+        query = session.query(Email.thread_id).filter(Email.is_embedded == False)
 
+        if attachment_wait > 0:
+            # give pending attachments a bounded time to be extracted first
+            cutoff = datetime.utcnow() - timedelta(seconds=attachment_wait)
+            waiting = session.query(Email.thread_id).join(Attachment).filter(
+                Attachment.extraction_status == "pending",
+                Attachment.created_at > cutoff)
+            query = query.filter(~Email.thread_id.in_(waiting))
+
+        # keyset pagination over thread ids
+        if after_thread_id is not None:
+            query = query.filter(Email.thread_id > after_thread_id)
+
+        thread_ids = [thread_id for (thread_id,) in query.distinct().order_by(Email.thread_id).limit(page_size)]
         if not thread_ids:
+            return []
 
-            print("[INFO] No pending email threads found for embedding.")
+        emails = (
+            session.query(Email)
+            .options(selectinload(Email.attachments))
+            .filter(Email.thread_id.in_(thread_ids))
+            .order_by(Email.thread_id, Email.date)
+            .all()
+        )
+
+        threads = {}
+        for email in emails:
+            threads.setdefault(email.thread_id, []).append(email)
+
+        # the objects stay usable after close(), everything the embedder reads is loaded
+        return list(threads.items())
+
+    finally:
+        session.close()
+
+
+def embed_pending_thread(thread, llm_model, embed_model, collection_name, chunk_size, dump_text_block):
 
-        else:
+    thread_id, emails = thread
 
-            for (thread_id,) in thread_ids:
+    try:
 
-                emails = session.query(Email).filter(Email.thread_id == thread_id).order_by(Email.date).all()
-                if not emails:
-                    continue
+        status, output = embed_thread_start(
+            emails,
+            thread_id,
+            llm_model,
+            embed_model,
+            collection_name,
+            chunk_size,
+            dump_text_block)
 
-                status, output = embed_thread_start(
-                    emails,
-                    thread_id,
-                    llm_model,
-                    embed_model,
-                    collection_name,
-                    chunk_size,
-                    dump_text_block)
+    except Exception as e:
+        print(f"[ERROR] Failed to embed thread {thread_id}: {e}")
+        return False
 
-                if not status:
-                    print(output)
-                    continue
+    if not status:
+        print(output)
+        return False
+
+    return True
+
+
+def mark_threads_embedded(threads):
+
+    email_ids = [e.id for emails in threads for e in emails]
+    pending_ids = [a.id for emails in threads for e in emails for a in e.attachments if a.extraction_status == "pending"]
+
+    if not email_ids:
+        return
+
+    session = SessionLocal()
 
-                try:
+    try:
 
-                    # Mark all emails in this thread as embedded
-                    for email in emails:
-                        email.is_embedded = True
+        # Attachments extracted while the thread was being embedded
+        # have reset is_embedded, leave those emails pending
+        extracted = set()
+        if pending_ids:
+            extracted = {email_id for (email_id,) in session.query(Attachment.email_id).filter(
+                Attachment.id == any_(bindparam("pending_ids", pending_ids, type_=ARRAY(String))),
+                Attachment.extraction_status != "pending")}
 
-                    session.commit()
+        # only the emails that were embedded, replies that arrived meanwhile stay pending
+        email_ids = [email_id for email_id in email_ids if email_id not in extracted]
 
-                except Exception as e:
-                    print(f"[ERROR] Failed to embed thread {thread_id}: {e}")
-                    continue
+        session.execute(
+            update(Email)
+            .where(Email.id == any_(bindparam("email_ids", email_ids, type_=ARRAY(String))))
+            .values(is_embedded=True)
+            .execution_options(synchronize_session=False)
+        )
 
+        session.commit()
+
+    except Exception as e:
+        session.rollback()
+        print(f"[ERROR] Failed to mark {len(threads)} threads as embedded: {e}")
+
+    finally:
         session.close()
 
-        time.sleep(10)
+
+def reset_embeddings(collection_name):
+    """ Mark every email as not embedded and forget the fingerprints of the collection. """
+
+    session = SessionLocal()
+
+    try:
+        session.execute(update(Email).values(is_embedded=False))
+        session.commit()
+    finally:
+        session.close()
+
+    clear_collection_fingerprints(collection_name)
+
+    print(f"[INFO] All emails will be embedded again into collection '{collection_name}'")
 
 
 def parse_arguments():
@@ -137,16 +298,95 @@ def parse_arguments():
 
     parser.add_argument(
         '--source',
-        choices=['gmail', 'mbox'],
+        choices=['gmail', 'mbox', 'maildir'],
         default='mbox',
-        help="Specify the email source: 'gmail' for OAuth Gmail access or 'mbox' to load from a local mailbox file."
+        help="Specify the email source: 'gmail' for OAuth Gmail access, 'mbox' to load from a local mailbox file or 'maildir' to load a Maildir tree / directory of .eml files."
     )
 
     parser.add_argument(
         '--mailbox',
         type=str,
         metavar='PATH',
-        help="Path to the MBOX email file (required if source is 'mbox')."
+        help="Path to the MBOX email file, or the mail directory for 'maildir' (required unless source is 'gmail')."
+    )
+
+    parser.add_argument(
+        '--follow',
+        action='store_true',
+        help="Keep running and load messages appended to the MBOX file (handles truncation and rotation)."
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help="Number of worker processes used to parse MBOX messages or mail files in parallel (default: 1)."
+    )
+
+    parser.add_argument(
+        '--since',
+        type=datetime.fromisoformat,
+        metavar='DATE',
+        help="Only load MBOX messages dated on or after this ISO date, e.g. 2024-01-31 (UTC unless an offset is given)."
+    )
+
+    parser.add_argument(
+        '--until',
+        type=datetime.fromisoformat,
+        metavar='DATE',
+        help="Only load MBOX messages dated before this ISO date (UTC unless an offset is given)."
+    )
+
+    parser.add_argument(
+        '--from_filter',
+        type=str,
+        metavar='TEXT',
+        help="Only load MBOX messages whose From header contains this text (case-insensitive)."
+    )
+
+    parser.add_argument(
+        '--defer_extraction',
+        action='store_true',
+        help="Store attachments right away with extraction_status 'pending' and extract their text in a background worker."
+    )
+
+    parser.add_argument(
+        '--attachment_wait',
+        type=int,
+        default=0,
+        metavar='SECONDS',
+        help="How long to hold back embedding of a thread with pending attachments (default: 0, embed now and re-embed once text arrives)."
+    )
+
+    parser.add_argument(
+        '--embed_workers',
+        type=int,
+        default=config.embed_workers,
+        help="Number of email threads embedded concurrently (default: config.embed_workers). Requests to RAG-Search are capped by config.rag_search_max_in_flight."
+    )
+
+    parser.add_argument(
+        '--embed_mode',
+        choices=['thread', 'incremental'],
+        help="Embed each thread as one document, or one document per email so new replies are appended without re-embedding the thread (default: config.embed_mode)."
+    )
+
+    parser.add_argument(
+        '--html_converter',
+        choices=['html2text', 'lxml'],
+        help="HTML to text converter for email bodies and HTML attachments (default: config.html_converter)."
+    )
+
+    parser.add_argument(
+        '--metrics_port',
+        type=int,
+        help="Serve Prometheus metrics at http://localhost:PORT/metrics (default: config.metrics_port)."
+    )
+
+    parser.add_argument(
+        '--gmail_fetch_format',
+        choices=['full', 'raw'],
+        help="Gmail fetch mode; 'raw' downloads each message once and parses it like an mbox message (default: config.gmail_fetch_format)."
     )
 
     parser.add_argument(
@@ -182,11 +422,17 @@ def parse_arguments():
         help="File path to save raw email thread text blocks (default: emails_dump.txt)."
     )
 
+    parser.add_argument(
+        '--reembed',
+        action='store_true',
+        help="Embed every email again, for example after the Qdrant collection was dropped or recreated."
+    )
+
     args = parser.parse_args()
 
-    # mailbox path must be set if source is 'mbox'
-    if args.source == 'mbox' and not args.mailbox:
-        parser.error("--mailbox is required when source is 'mbox'.")
+    # mailbox path must be set for local sources
+    if args.source in ('mbox', 'maildir') and not args.mailbox:
+        parser.error(f"--mailbox is required when source is '{args.source}'.")
 
     # default collection name if not provided
     if not args.collection_name:
@@ -199,10 +445,32 @@ if __name__ == "__main__":
 
     parser = parse_arguments()
 
+    if parser.html_converter:
+        config.html_converter = parser.html_converter
+
+    if parser.embed_mode:
+        config.embed_mode = parser.embed_mode
+
+    if parser.gmail_fetch_format:
+        config.gmail_fetch_format = parser.gmail_fetch_format
+
+    metrics_port = parser.metrics_port or config.metrics_port
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+
     run_pipeline(source=parser.source,
                  mailbox=parser.mailbox,
+                 follow=parser.follow,
+                 workers=parser.workers,
+                 since=parser.since,
+                 until=parser.until,
+                 from_filter=parser.from_filter,
+                 defer_extraction=parser.defer_extraction,
+                 attachment_wait=parser.attachment_wait,
+                 embed_workers=parser.embed_workers,
                  llm_model=parser.llm_model,
                  embed_model=parser.embed_model,
                  chunk_size=parser.chunk_size,
                  collection_name=parser.collection_name,
-                 dump_text_block=parser.dump_text_block)
+                 dump_text_block=parser.dump_text_block,
+                 reembed=parser.reembed)
@@ -0,0 +1,92 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy.dialects.postgresql import insert
+from db.session import SessionLocal
+from db.models import AttachmentText
+
+
+class Attachment_text_cache():
+    """ Extracted attachment text keyed by SHA-256 of the attachment bytes and the extractor version. """
+
+    def __init__(self, max_entries=2048):
+
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def content_hash(self, binary_data):
+
+        return hashlib.sha256(binary_data).hexdigest()
+
+
+    def get(self, content_hash, extractor_version):
+
+        key = (content_hash, extractor_version)
+
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+        session = SessionLocal()
+        try:
+            row = session.get(AttachmentText, key)
+        except Exception as e:
+            print(f"[WARN] attachment cache lookup failed: {e}")
+            row = None
+        finally:
+            session.close()
+
+        if row is None:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        self._remember(key, row.text_content)
+
+        with self.lock:
+            self.hits += 1
+
+        return row.text_content
+
+
+    def put(self, content_hash, extractor_version, mime_type, text_content):
+
+        key = (content_hash, extractor_version)
+        self._remember(key, text_content)
+
+        session = SessionLocal()
+        try:
+            stmt = insert(AttachmentText).values(
+                content_hash=content_hash,
+                extractor_version=extractor_version,
+                mime_type=mime_type,
+                text_content=text_content,
+                created_at=datetime.utcnow()
+            ).on_conflict_do_nothing()
+            session.execute(stmt)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"[WARN] attachment cache store failed: {e}")
+        finally:
+            session.close()
+
+
+    def _remember(self, key, text_content):
+
+        with self.lock:
+            self.memory[key] = text_content
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+
+attachment_cache = Attachment_text_cache()
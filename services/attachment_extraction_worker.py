@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import update
+from sqlalchemy.orm import undefer
+
+import config
+from db.session import SessionLocal
+from db.models import Email, Attachment
+from services.email_loader import EXTRACTOR_VERSION
+from services.attachment_cache import attachment_cache
+from services.attachment_extractor import attachment_extractor
+
+
+def extract_pending_attachments(batch_size=50):
+    """ Fill in text_content of attachments stored with extraction_status 'pending'. Returns the number processed. """
+
+    session = SessionLocal()
+
+    try:
+
+        attachments = (
+            session.query(Attachment)
+            .options(undefer(Attachment.content))
+            .filter(Attachment.extraction_status == "pending")
+            .order_by(Attachment.created_at)
+            .limit(batch_size)
+            .all()
+        )
+
+        if not attachments:
+            return 0
+
+        # the extractor bounds the real parallelism with its own process pool
+        with ThreadPoolExecutor(max_workers=config.extraction_workers) as executor:
+            results = list(executor.map(extract_attachment_text, attachments))
+
+        for attachment, (status, text_data) in zip(attachments, results):
+
+            attachment.extraction_status = status
+            attachment.text_content = text_data
+
+            if not config.keep_attachment_content:
+                attachment.content = None
+
+            print(f"[INFO] Extracted attachment '{attachment.filename}' ({attachment.mime_type}): {status}")
+
+        # threads that were already embedded without this text are embedded again
+        email_ids = list({a.email_id for a in attachments if a.text_content})
+        if email_ids:
+            session.execute(
+                update(Email)
+                .where(Email.id.in_(email_ids))
+                .values(is_embedded=False)
+            )
+
+        session.commit()
+
+        return len(attachments)
+
+    except Exception as e:
+        session.rollback()
+        print(f"[ERROR] Failed to extract pending attachments: {e}")
+        return 0
+
+    finally:
+        session.close()
+
+
+def extract_attachment_text(attachment):
+
+    if attachment.content is None:
+        return "failed", None
+
+    if attachment.content_hash:
+        text_data = attachment_cache.get(attachment.content_hash, EXTRACTOR_VERSION)
+        if text_data is not None:
+            return "done", text_data
+
+    status, text_data = attachment_extractor.extract(attachment.mime_type, attachment.content)
+
+    if status == "done" and attachment.content_hash:
+        attachment_cache.put(attachment.content_hash, EXTRACTOR_VERSION, attachment.mime_type, text_data)
+
+    return status, text_data
@@ -0,0 +1,191 @@
+import os
+import time
+import threading
+import multiprocessing
+
+import config
+
+# Wall-clock limit (seconds) per effective MIME type
+extraction_timeouts = {
+    "application/pdf": 120,
+    "image/jpeg": 60,
+    "image/png": 60,
+    "application/zip": 60,
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": 60,
+    "message/rfc822": 30,
+    "text/html": 30,
+}
+
+# Times an extraction is submitted again after its pool was restarted for another job's timeout
+max_resubmits = 3
+
+supported_mime_types = {
+    "text/csv",
+    "text/plain",
+    "application/x-wine-extension-ini",
+    "application/json",
+    *extraction_timeouts.keys()
+}
+
+
+# Workers are started fresh, not forked: a fork taken while another thread (Gmail batches, embedding, polling)
+# holds a lock such as the stdout buffer or the DB pool can deadlock the child. Unlike forkserver, spawn keeps
+# working in the forked parser processes of the mbox and Maildir loaders
+pool_context = multiprocessing.get_context("spawn")
+
+
+class Attachment_extractor():
+    """ Run attachment text extraction in a worker process pool with per-type timeouts and size caps.
+
+    extract() returns (status, text) where status is one of:
+        done        - text extracted (possibly empty)
+        unsupported - no extractor for this MIME type
+        too_large   - input exceeds max_input_bytes, not attempted
+        timeout     - extraction exceeded its time limit and the worker was killed
+        failed      - the extractor raised an error or its worker died
+
+    A job that was killed because another attachment timed out on the same pool is submitted again.
+    """
+
+    def __init__(self,
+                 workers=config.extraction_workers,
+                 max_input_bytes=config.extraction_max_input_bytes,
+                 max_pages=config.extraction_max_pages,
+                 max_output_chars=config.extraction_max_output_chars,
+                 default_timeout=30):
+
+        self.workers = workers
+        self.max_input_bytes = max_input_bytes
+        self.max_pages = max_pages
+        self.max_output_chars = max_output_chars
+        self.default_timeout = default_timeout
+
+        self.pool = None
+        self.lock = threading.Lock()
+
+        # bumped on every pool restart, jobs submitted to an older pool were killed with it
+        self.generation = 0
+
+        # a forked process (e.g. a parser pool worker) must not use the parent's pool or a lock held at fork time
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+
+    def check(self, effective_mime, size):
+        """ Status of an input that is rejected without running an extractor, None if it would be extracted. """
+
+        if effective_mime not in supported_mime_types:
+            return "unsupported"
+
+        if size > self.max_input_bytes:
+            return "too_large"
+
+        return None
+
+
+    def extract(self, effective_mime, binary_data):
+
+        status = self.check(effective_mime, len(binary_data))
+
+        if status == "unsupported":
+            print(f"Warning: unsupported MIME type: {effective_mime}")
+
+        if status:
+            return status, ""
+
+        timeout = extraction_timeouts.get(effective_mime, self.default_timeout)
+
+        for _ in range(max_resubmits + 1):
+
+            pool, generation = self._get_pool()
+
+            try:
+                job = pool.apply_async(_run_extraction, (effective_mime, binary_data, self.max_pages, self.max_output_chars))
+            except ValueError:
+                # the pool was terminated after we got it
+                continue
+
+            result = self._wait_for_job(job, pool, generation, timeout)
+            if result is not None:
+                return result
+
+            print(f"[WARN] attachment extraction was killed by a pool restart, submitting it again ({effective_mime})")
+
+        return "failed", ""
+
+
+    def _wait_for_job(self, job, pool, generation, timeout):
+        """ Returns (status, text), or None when the job was killed by a restart caused by another job. """
+
+        deadline = time.monotonic() + timeout
+
+        while True:
+
+            job.wait(min(0.5, max(0, deadline - time.monotonic())))
+
+            if job.ready():
+                try:
+                    return job.get()
+                except Exception as e:
+                    print(f"Error: attachment extraction worker failed: {e}")
+                    return "failed", ""
+
+            if self.generation != generation:
+                return None
+
+            if time.monotonic() >= deadline:
+                # a hung parser cannot be interrupted, kill its worker along with the pool
+                self._restart_pool(pool)
+                return "timeout", ""
+
+
+    def close(self):
+
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+
+
+    def _get_pool(self):
+
+        with self.lock:
+            if self.pool is None:
+                # recycle workers to keep leaks in native parsers bounded
+                self.pool = pool_context.Pool(processes=self.workers, maxtasksperchild=100)
+            return self.pool, self.generation
+
+
+    def _restart_pool(self, pool):
+
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+                self.generation += 1
+
+        pool.terminate()
+
+
+    def _reset_after_fork(self):
+
+        self.pool = None
+        self.lock = threading.Lock()
+
+
+def _run_extraction(effective_mime, binary_data, max_pages, max_output_chars):
+
+    # imported here to avoid a circular import with services.email_loader
+    from services.email_loader import Email_loader
+
+    try:
+        text_data = Email_loader().extract_text_strict(effective_mime, binary_data, max_pages, max_output_chars)
+    except Exception as e:
+        print(f"Error: extract_text: {e}")
+        return "failed", ""
+
+    if max_output_chars and len(text_data) > max_output_chars:
+        text_data = text_data[:max_output_chars]
+
+    return "done", text_data
+
+
+attachment_extractor = Attachment_extractor()
@@ -2,8 +2,20 @@
 import re
 import json
 import difflib
+import hashlib
+import threading
+from datetime import datetime
 
+import config
 import services.rag_search_remote
+from services.text_splitter import text_splitter
+from services.token_counter import token_counter
+from services.summary_cache import summary_cache
+from db.session import SessionLocal
+from db.models import ThreadEmbedding, EmailEmbedding
+
+# embedding workers append to the same dump file
+dump_lock = threading.Lock()
 
 quoted_reply_patterns = [
     r"On .+?wrote:",                    # Gmail-style replies
@@ -47,6 +59,9 @@ Highlight help requests clearly (if any) so a human can follow up if needed.
 Here is the email thread:
 """
 
+# Bump whenever summaries change for the same prompt and text (e.g. the LLM call or its post-processing), so cached summaries are made again
+SUMMARY_PROMPT_VERSION = 1
+
 summarization_combine_prompt = f"""
 You are an assistant that combines multiple partial summaries of an email thread into one cohesive final summary.
 
@@ -62,13 +77,37 @@ Here are the partial summaries:
 
 def embed_thread_start(emails, thread_id, llm_model, embed_model, collection_name, chunk_size, dump_text_block, max_chunks=3):
 
+    text_block = get_thread_text(emails)
+
+    chunk_settings = get_chunk_settings(embed_model, chunk_size)
+    if chunk_settings is None:
+        return False, "Cannot compute chunk size"
+
+    # the same text embedded with the same settings produces the same vectors
+    fingerprint = get_thread_fingerprint(text_block, llm_model, embed_model, chunk_settings, collection_name)
+    if fingerprint == load_thread_fingerprint(thread_id, collection_name):
+        print(f"[INFO] Thread {thread_id} is unchanged since it was last embedded, skipping.")
+        return True, None
+
+    if text_block and config.embed_mode == "incremental":
+        return embed_thread_incremental(emails, thread_id, embed_model, collection_name, chunk_size, dump_text_block, fingerprint, llm_model, chunk_settings)
+
+    # fitted to the text only once the thread is known to have changed
+    effective_chunk_size = resolve_chunk_size(embed_model, chunk_size, text_block)
+    if effective_chunk_size is None:
+        return False, "Cannot compute chunk size"
+
+    chunk_size = get_paste_chunk_size(embed_model, chunk_size, effective_chunk_size)
+
     # Remove old embeddings for this thread
     status, output = services.rag_search_remote.remove_embed_email_thread(collection_name, thread_id)
     if not status:
         return False, f"Error: {output}"
 
-    text_block = get_thread_text(emails)
+    clear_email_fingerprints(thread_id, collection_name)
+
     if not text_block:
+        save_thread_fingerprint(thread_id, collection_name, fingerprint, llm_model, embed_model, effective_chunk_size)
         return True, None
 
     #######
@@ -82,7 +121,7 @@ def embed_thread_start(emails, thread_id, llm_model, embed_model, collection_nam
 
     if should_summarize:
 
-        status, output = summarize_thread_text(text_block, llm_model)
+        status, output = summarize_thread_text(text_block, llm_model, emails)
         if not status:
             return False, f"Summarization failed: {output}"
 
@@ -127,15 +166,271 @@ def embed_thread_start(emails, thread_id, llm_model, embed_model, collection_nam
 
     # record only on successful embedding!
     save_thread_to_file(dump_text_block, text_block, text_block_summarized, metadata)
+    save_thread_fingerprint(thread_id, collection_name, fingerprint, llm_model, embed_model, effective_chunk_size)
+
+    return True, None
+
+
+def embed_thread_incremental(emails, thread_id, embed_model, collection_name, chunk_size, dump_text_block, fingerprint, llm_model, chunk_settings):
+    """ Embed one document per email. Only emails that are new or whose text changed are sent, unless the thread drifted too far. """
+
+    documents = get_email_documents(emails, thread_id)
+
+    current = {email_id: get_text_fingerprint(text, embed_model, chunk_settings, collection_name) for email_id, text, _ in documents}
+
+    session = SessionLocal()
+
+    try:
+
+        state = session.get(ThreadEmbedding, (thread_id, collection_name))
+        stored = {
+            row.email_id: row.fingerprint
+            for row in session.query(EmailEmbedding).filter(EmailEmbedding.thread_id == thread_id,
+                                                            EmailEmbedding.collection_name == collection_name)
+        }
+
+        added = [email_id for email_id in current if email_id not in stored]
+        changed = [email_id for email_id in current if email_id in stored and stored[email_id] != current[email_id]]
+        removed = [email_id for email_id in stored if email_id not in current]
+
+        # thread-level metadata and context of older documents go stale as the thread grows
+        if state is None or state.mode != "incremental":
+            rebuild = True
+        else:
+            drift = (state.drift_count or 0) + len(added) + len(changed) + len(removed)
+            rebuild = drift > config.incremental_drift_threshold * max(1, state.base_email_count or 0)
+
+        if rebuild:
+
+            status, output = services.rag_search_remote.remove_embed_email_thread(collection_name, thread_id)
+            if not status:
+                return False, f"Error: {output}"
+
+            session.query(EmailEmbedding).filter(EmailEmbedding.thread_id == thread_id,
+                                                 EmailEmbedding.collection_name == collection_name).delete()
+            session.commit()
+
+            to_embed = set(current)
+
+        else:
+
+            for email_id in changed + removed:
+                status, output = services.rag_search_remote.remove_embed_email(collection_name, thread_id, email_id)
+                if not status:
+                    return False, f"Error: {output}"
+
+            if removed:
+                session.query(EmailEmbedding).filter(EmailEmbedding.email_id.in_(removed),
+                                                     EmailEmbedding.collection_name == collection_name).delete()
+                session.commit()
+
+            to_embed = set(added + changed)
+
+        print(f"""[INFO] Embedding thread {thread_id} incrementally:
+        Subject           : "{emails[0].subject}"
+        Email Count       : {len(emails)}
+        Emails Embedded   : {len(to_embed)}
+        Full Rebuild      : {rebuild}""")
+
+        embedded_text = []
+
+        for email_id, text, metadata in documents:
+
+            if email_id not in to_embed:
+                continue
+
+            # each email is sized on its own text, only when it is sent
+            effective_chunk_size = resolve_chunk_size(embed_model, chunk_size, text)
+            if effective_chunk_size is None:
+                return False, "Cannot compute chunk size"
+
+            status, output = services.rag_search_remote.embed_email_thread(text,
+                collection_name,
+                embed_model,
+                metadata,
+                separators,
+                get_paste_chunk_size(embed_model, chunk_size, effective_chunk_size))
+
+            if not status:
+                return False, output
+
+            # recorded per email, a retry after a failure does not paste the same email twice
+            session.merge(EmailEmbedding(email_id=email_id,
+                                         collection_name=collection_name,
+                                         thread_id=thread_id,
+                                         fingerprint=current[email_id],
+                                         updated_at=datetime.utcnow()))
+            session.commit()
+
+            embedded_text.append(text)
+
+        if rebuild:
+            base_email_count, drift_count = len(current), 0
+        else:
+            base_email_count, drift_count = state.base_email_count, drift
+
+        session.merge(ThreadEmbedding(thread_id=thread_id,
+                                      collection_name=collection_name,
+                                      fingerprint=fingerprint,
+                                      embed_model=embed_model,
+                                      llm_model=llm_model,
+                                      chunk_size=chunk_size,
+                                      mode="incremental",
+                                      base_email_count=base_email_count,
+                                      drift_count=drift_count,
+                                      updated_at=datetime.utcnow()))
+        session.commit()
+
+    except Exception as e:
+        session.rollback()
+        return False, f"Error: incremental embedding of thread {thread_id} failed: {e}"
+
+    finally:
+        session.close()
+
+    if embedded_text:
+        save_thread_to_file(dump_text_block, "\n\n".join(embedded_text), "", {"thread_id": thread_id, "emails_embedded": len(embedded_text)})
 
     return True, None
 
 
+def get_email_documents(emails, thread_id):
+    """ One (email_id, text, metadata) per email with content, for the incremental mode. """
+
+    subject = emails[0].subject.strip() if emails[0].subject else "(no subject)"
+    dates = [e.date for e in emails if e.date]
+
+    documents = []
+    previous_part = ""
+
+    for i, email, part in get_email_parts(emails):
+
+        context = ""
+        if previous_part and config.incremental_context_chars:
+            context = f"Previous email (excerpt):\n...{previous_part[-config.incremental_context_chars:]}\n\n"
+
+        text = remove_links(f"Subject: {subject}\n\n{context}{part}")
+        previous_part = part
+
+        metadata = {
+            "type"              : "email",
+            "thread_id"         : thread_id,
+            "email_id"          : email.id,
+            "email_index"       : i + 1,
+            "subject"           : emails[0].subject,
+            "sender"            : email.sender,
+            "email_count"       : len(emails),
+            "attachments_count" : len(email.attachments),
+            "email_date"        : str(email.date),
+            "first_email_date"  : str(min(dates)) if dates else None,
+            "last_email_date"   : str(max(dates)) if dates else None,
+            "text_block_len"    : len(text),
+            "is_summarized"     : False
+        }
+
+        documents.append((email.id, text, metadata))
+
+    return documents
+
+
+def get_thread_fingerprint(text_block, llm_model, embed_model, chunk_settings, collection_name):
+
+    # the text before summarization plus the LLM model, so an unchanged thread skips summarization too
+    key = json.dumps([text_block, llm_model, embed_model, chunk_settings, collection_name, config.embed_mode])
+
+    return hashlib.sha256(key.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+def get_text_fingerprint(text, embed_model, chunk_settings, collection_name):
+
+    key = json.dumps([text, embed_model, chunk_settings, collection_name])
+
+    return hashlib.sha256(key.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+def clear_email_fingerprints(thread_id, collection_name):
+
+    session = SessionLocal()
+
+    try:
+        session.query(EmailEmbedding).filter(EmailEmbedding.thread_id == thread_id,
+                                             EmailEmbedding.collection_name == collection_name).delete()
+        session.commit()
+    finally:
+        session.close()
+
+
+def clear_collection_fingerprints(collection_name):
+    """ Forget every thread and email embedded into the collection, so none of them is skipped as unchanged. """
+
+    session = SessionLocal()
+
+    try:
+        session.query(EmailEmbedding).filter(EmailEmbedding.collection_name == collection_name).delete()
+        session.query(ThreadEmbedding).filter(ThreadEmbedding.collection_name == collection_name).delete()
+        session.commit()
+    finally:
+        session.close()
+
+
+def load_thread_fingerprint(thread_id, collection_name):
+
+    session = SessionLocal()
+
+    try:
+        row = session.get(ThreadEmbedding, (thread_id, collection_name))
+        return row.fingerprint if row else None
+    finally:
+        session.close()
+
+
+def save_thread_fingerprint(thread_id, collection_name, fingerprint, llm_model, embed_model, chunk_size):
+    """ Records a thread embedded as a whole. The mode is written too, so switching to incremental rebuilds it. """
+
+    session = SessionLocal()
+
+    try:
+        session.merge(ThreadEmbedding(thread_id=thread_id,
+                                      collection_name=collection_name,
+                                      fingerprint=fingerprint,
+                                      embed_model=embed_model,
+                                      llm_model=llm_model,
+                                      chunk_size=chunk_size,
+                                      mode="thread",
+                                      base_email_count=None,
+                                      drift_count=0,
+                                      updated_at=datetime.utcnow()))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"[WARN] Cannot save fingerprint of thread {thread_id}: {e}")
+    finally:
+        session.close()
+
+
 def get_thread_text(emails):
 
     subject = emails[0].subject.strip() if emails[0].subject else "(no subject)"
 
-    text_block_list = []
+    text_block_list = [part for _, _, part in get_email_parts(emails)]
+
+    if not text_block_list:
+        return ""
+
+    text_block = "\n\n".join(text_block_list)
+
+    text_block = (
+        f"===== Begin Email Thread =====\n\n"
+        f"Subject: {subject}\n\n"
+        f"{text_block}\n\n"
+        f"===== End Email Thread ====="
+    )
+
+    return remove_links(text_block)
+
+
+def get_email_parts(emails):
+    """ Yield (index, email, part) for every email with a body, quoted replies removed and attachment text appended. """
 
     for i, email in enumerate(emails):
 
@@ -162,21 +457,8 @@ def get_thread_text(emails):
                 )
 
         part += "\n--- End Email ---"
-        text_block_list.append(part)
-
-    if not text_block_list:
-        return ""
-
-    text_block = "\n\n".join(text_block_list)
-
-    text_block = (
-        f"===== Begin Email Thread =====\n\n"
-        f"Subject: {subject}\n\n"
-        f"{text_block}\n\n"
-        f"===== End Email Thread ====="
-    )
 
-    return remove_links(text_block)
+        yield i, email, part
 
 
 def remove_quoted_body(idx, emails):
@@ -215,50 +497,97 @@ def remove_links(text):
     return re.sub(url_pattern, '', text)
 
 
-def compute_chunk_size(text_block, embed_model, chunk_size):
+def get_chunk_settings(embed_model, chunk_size):
+    """ The inputs the chunk size is fitted from, for fingerprints. Cheap, unlike fitting the chunk size to a text. """
 
-    if not chunk_size:
+    if chunk_size:
+        return [chunk_size]
 
-        status, output = get_max_characters_embedding(embed_model)
-        if not status:
-            print(f"Error: get_max_characters_embedding: {output}")
-            return None
+    status, output = services.rag_search_remote.get_max_tokens(embed_model)
+    if not status:
+        print(f"Error: get_max_tokens: {output}")
+        return None
 
-        if not isinstance(output, int):
-            print(f"unexpected format: {type(output)}")
-            return None
+    # the fitted size only depends on the text and these
+    return [None, int(output), token_counter.tokenizer_id(embed_model), config.avg_chars_per_token]
 
-        chunk_size = output
 
-    #######
+def resolve_chunk_size(embed_model, chunk_size, text_block=""):
+
+    if chunk_size:
+        return chunk_size
 
-    status, output = services.rag_search_remote.split_document(text_block,
-                                                             chunk_size,
-                                                             separators)
+    status, output = get_max_characters_embedding(embed_model, text_block)
     if not status:
-        print(f"Error: split_document: {output}")
+        print(f"Error: get_max_characters_embedding: {output}")
+        return None
+
+    if not isinstance(output, int):
+        print(f"unexpected format: {type(output)}")
         return None
 
-    chunks_map = output
+    return output
+
+
+def get_paste_chunk_size(embed_model, chunk_size, effective_chunk_size):
+    """ Chunk size sent to /paste. None lets RAG-Search estimate it from the model's token limit. """
+
+    # fitted to this text with the model's tokenizer, RAG-Search's own estimate is not
+    if not chunk_size and token_counter.get_tokenizer(embed_model):
+        return effective_chunk_size
+
+    return chunk_size
+
 
-    return chunks_map.get("count", None)
+def fit_chunk_size(text_block, model, max_tokens, max_rounds=8):
+    """ Largest character chunk size found whose chunks of this text all fit in max_tokens of the model's tokenizer.
+    RAG-Search splits /paste by characters with the same rules, so its chunks fit as well. """
 
+    if not text_block or token_counter.get_tokenizer(model) is None:
+        return int(max_tokens * config.avg_chars_per_token)
 
-def get_max_characters_embedding(embed_model):
+    # start from the average of the whole text, dense parts (logs, code, base64) then shrink it
+    chunk_size = int(max_tokens * token_counter.chars_per_token(model, text_block))
+
+    for _ in range(max_rounds):
+
+        if chunk_size <= max_tokens:
+            break
+
+        chunks = text_splitter.split(text_block, chunk_size, separators)
+        longest = max((token_counter.count(chunk, model) for chunk in chunks), default=0)
+
+        if longest <= max_tokens:
+            return chunk_size
+
+        chunk_size = min(chunk_size - 1, int(chunk_size * max_tokens / longest))
+
+    # every token covers at least one character, so this always fits
+    return max_tokens
+
+
+def compute_chunk_size(text_block, embed_model, chunk_size):
+
+    chunk_size = resolve_chunk_size(embed_model, chunk_size, text_block)
+    if chunk_size is None:
+        return None
+
+    # split locally, the text only goes over the wire once, to /paste
+    return len(text_splitter.split(text_block, chunk_size, separators))
+
+
+def get_max_characters_embedding(embed_model, text_block=""):
 
     status, output = services.rag_search_remote.get_max_tokens(embed_model)
     if not status:
         return False, output
 
-    max_tokens = int(output)
+    max_tokens = int(output) - token_counter.special_tokens(embed_model)
 
-    avg_chars_per_token = 3.5  # in English
-    approx_max_characters = max_tokens * avg_chars_per_token
+    return True, fit_chunk_size(text_block, embed_model, max_tokens)
 
-    return True, int(approx_max_characters)
 
-
-def get_max_characters_llm(llm_model):
+def get_max_tokens_llm(llm_model):
 
     status, output = services.rag_search_remote.get_llm_info(llm_model)
     if not status:
@@ -268,37 +597,36 @@ def get_max_characters_llm(llm_model):
     if not context_len:
         return False, f"cannot get context length of LLM model {llm_model}"
 
-    avg_chars_per_token = 3.5  # in English
-    approx_max_characters = int(context_len) * avg_chars_per_token
-
-    return True, int(approx_max_characters)
+    return True, int(context_len)
 
 
-def summarize_thread_text(text_block, llm_model):
+def summarize_thread_text(text_block, llm_model, emails=None):
 
     def run_llm_summary(text_block):
-        llm_prompt = f"{summarization_prompt}\n\n{text_block}"
-        return services.rag_search_remote.llm_chat(llm_prompt, llm_model, session_id="llm_summarize")
+        return run_llm_cached(summarization_prompt, text_block, llm_model, "llm_summarize")
 
-    status, output = get_max_characters_llm(llm_model)
+    status, output = get_max_tokens_llm(llm_model)
     if not status:
-        return False, f"Error: get_max_characters_llm: {output}"
+        return False, f"Error: get_max_tokens_llm: {output}"
 
-    context_length_characters = int(output)
-    total_characters = len(text_block) + len(summarization_prompt)
+    context_tokens = output
+    total_tokens = token_counter.count(f"{summarization_prompt}\n\n{text_block}", llm_model)
 
     # Entire thread fits within LLM context window
-    if total_characters <= context_length_characters:
+    if total_tokens <= context_tokens:
         return run_llm_summary(text_block)
 
-    print(f"[INFO] Falling back to hierarchical summarization — total {total_characters} chars")
+    print(f"[INFO] Falling back to hierarchical summarization — total {total_tokens} tokens")
 
-    chunk_size = context_length_characters - len(summarization_prompt)
-    status, output = services.rag_search_remote.split_document(text_block, chunk_size, separators)
-    if not status:
-        return False, f"Error: split_document: {output}"
-
-    chunks_list = output.get("chunks", [])
+    if emails:
+        status, output = get_email_windows(emails, llm_model)
+        if not status:
+            return False, output
+        chunks_list = output
+    else:
+        max_tokens = context_tokens - token_counter.count(summarization_prompt, llm_model)
+        chunk_size = fit_chunk_size(text_block, llm_model, max_tokens)
+        chunks_list = text_splitter.split(text_block, chunk_size, separators)
 
     summaries = []
     for chunk in chunks_list:
@@ -309,12 +637,70 @@ def summarize_thread_text(text_block, llm_model):
 
     # Summarize the combined group summaries
     combined_summary_text = "\n\n".join(summaries)
-    llm_prompt = f"{summarization_combine_prompt}\n\n{combined_summary_text}"
-    status, final_summary = services.rag_search_remote.llm_chat(llm_prompt, llm_model, session_id="llm_combine_summary")
+    return run_llm_cached(summarization_combine_prompt, combined_summary_text, llm_model, "llm_combine_summary")
+
+
+def get_email_windows(emails, llm_model):
+    """ Pack whole emails, in order, into windows that fit the LLM context next to the summarization prompt.
+    A new reply only changes the last window, the summaries of the others come from the summary cache. """
+
+    status, output = get_max_tokens_llm(llm_model)
     if not status:
-        return False, final_summary
+        return False, f"Error: get_max_tokens_llm: {output}"
+
+    subject = emails[0].subject.strip() if emails[0].subject else "(no subject)"
+    header = f"Subject: {subject}\n\n"
+
+    # counted per email in real tokens, so window boundaries do not move as the thread grows
+    max_tokens = output - token_counter.count(f"{summarization_prompt}\n\n{header}", llm_model)
+
+    windows = []
+    current = []
+    current_tokens = 0
+
+    for _, _, part in get_email_parts(emails):
+
+        part = remove_links(part)
+        tokens = token_counter.count(f"{part}\n\n", llm_model)
+
+        if current and (current_tokens + tokens > max_tokens or tokens > max_tokens):
+            windows.append(header + "\n\n".join(current))
+            current = []
+            current_tokens = 0
+
+        if tokens <= max_tokens:
+            current.append(part)
+            current_tokens += tokens
+            continue
+
+        # an email longer than a window is split on its own
+        chunk_size = fit_chunk_size(part, llm_model, max_tokens)
+        windows.extend(header + chunk for chunk in text_splitter.split(part, chunk_size, separators))
+
+    if current:
+        windows.append(header + "\n\n".join(current))
+
+    return True, windows
+
+
+def run_llm_cached(prompt, text_block, llm_model, session_id):
+    """ Ask the LLM for a summary, unless the same prompt, text and model were summarized before. """
+
+    content_hash = summary_cache.content_hash(prompt, text_block)
+
+    summary = summary_cache.get(content_hash, llm_model, SUMMARY_PROMPT_VERSION)
+    if summary is not None:
+        return True, summary
+
+    llm_prompt = f"{prompt}\n\n{text_block}"
+    status, output = services.rag_search_remote.llm_chat(llm_prompt, llm_model, session_id=session_id)
+    if not status:
+        return False, output
+
+    if isinstance(output, str):
+        summary_cache.put(content_hash, llm_model, SUMMARY_PROMPT_VERSION, output)
 
-    return True, final_summary
+    return True, output
 
 
 def save_thread_to_file(dump_text_block, text_block, text_block_summarized, metadata):
@@ -325,7 +711,7 @@ def save_thread_to_file(dump_text_block, text_block, text_block_summarized, meta
         "============================================\n\n"
     )
 
-    with open(dump_text_block, "a", encoding="utf-8") as f:
+    with dump_lock, open(dump_text_block, "a", encoding="utf-8") as f:
 
         f.write(header)
         f.write("METADATA:\n")
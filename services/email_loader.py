@@ -1,5 +1,9 @@
 
 import os
+import uuid
+import codecs
+import shutil
+import tempfile
 import mimetypes
 import magic
 import json
@@ -9,15 +13,365 @@ import re
 import pytesseract
 import html2text
 
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+except ImportError:
+    etree = None
+    lxml_html = None
+
+from collections import deque
+from contextlib import closing
+from datetime import datetime
+from datetime import timezone
 from email import message_from_bytes
+from email import message_from_binary_file
+from email.utils import parsedate_to_datetime
+from email.utils import parseaddr
+from email.header import decode_header, make_header
 from email.policy import default
 from docx import Document
 from io import BytesIO
 from PIL import Image
 
+import config
+
+from services.attachment_cache import attachment_cache
+from db.models import Email
+from db.session import engine
+from services.attachment_extractor import attachment_extractor
+
+# Bump whenever extract_text() output changes, so cached texts are extracted again
+EXTRACTOR_VERSION = 2
+
+zip_text_extensions = (".txt", ".log", ".md", ".csv", ".json", ".yaml", ".yml")
+
+invisible_chars_re = re.compile(r"[\u200c\u200d\u200e\u200f\u202a-\u202e\u2060-\u206f\u00ad\xa0]")
+spaces_re = re.compile(r"[ \t]+")
+blank_lines_re = re.compile(r"\n\s*\n+")
+
+html_paragraph_tags = ("p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol", "table", "blockquote", "pre", "hr")
+html_line_tags = ("br", "li", "tr")
+
+if lxml_html is not None:
+    lxml_parser = lxml_html.HTMLParser(encoding="utf-8", remove_comments=True)
+
 
 class Email_loader():
 
+    # store attachments as 'pending' and leave extraction to attachment_extraction_worker
+    defer_extraction = False
+
+    # header-only prefilter state, see _check_headers()
+    known_ids = None
+    since = None
+    until = None
+    from_filter = None
+
+    # 'html2text' or 'lxml' (faster, needs the lxml package), defaults to config.html_converter
+    html_converter = None
+
+    def build_rows(self, record):
+
+        email_row = {
+            "id": record["id"],
+            "thread_id": record["thread_id"],
+            "references": record["references"],
+            "in_reply_to": record["in_reply_to"],
+            "sender": record["sender"],
+            "recipients": record["recipients"],
+            "date": record["date"] or datetime.utcnow(),
+            "subject": record["subject"],
+            "body": record["body"],
+            "is_embedded": False,
+            "gmail_id": record.get("gmail_id")
+        }
+
+        attachment_rows = []
+
+        for filename, meta in record["attachments"].items():
+
+            attachment_rows.append({
+                "id": str(uuid.uuid4()),
+                "email_id": record["id"],
+                "filename": filename,
+                "mime_type": meta.get("mime_type"),
+                "extension": meta.get("extension"),
+                "size": meta.get("size"),
+                "text_content": meta.get("text"),
+                "content_hash": meta.get("content_hash"),
+                "extraction_status": meta.get("status"),
+                "content": meta.get("content"),
+                "created_at": datetime.utcnow()
+            })
+
+        return email_row, attachment_rows
+
+
+    def iter_pool_results(self, executor, fn, tasks, window):
+        """ Submit tasks to an executor keeping at most 'window' in flight, yield (task, result) in submission order. """
+
+        tasks = iter(tasks)
+        pending = deque()
+
+        for _ in range(window):
+            task = next(tasks, None)
+            if task is None:
+                break
+            pending.append((task, executor.submit(fn, task)))
+
+        while pending:
+
+            task, future = pending.popleft()
+            result = future.result()
+
+            next_task = next(tasks, None)
+            if next_task is not None:
+                pending.append((next_task, executor.submit(fn, next_task)))
+
+            yield task, result
+
+
+    def _parse_message(self, message):
+
+        message_id = message.get("Message-ID", None)
+        if not message_id:
+            return None
+
+        subject = self._decode_header_value(message.get("Subject", ""))
+        sender = self._decode_header_value(message.get("From", ""))
+
+        recipients_raw = message.get_all("To", [])
+
+        recipients = []
+        for r in recipients_raw:
+            decoded = self._decode_header_value(r)
+            _, email = parseaddr(decoded)
+            if email:
+                recipients.append(email)
+
+        # Parse date
+        date = message.get("Date")
+        try:
+            parsed_date = parsedate_to_datetime(date) if date else None
+        except Exception:
+            print(f"Error: parsing email date: {date}")
+            parsed_date = None
+
+        references_raw = message.get('References', '')
+        references_list = references_raw.split() if references_raw else []
+
+        in_reply_to = self._decode_header_value(message.get("In-Reply-To", ""))
+
+        return {
+            "id": message_id,
+            "thread_id": self._build_thread_id(message),
+            "references": references_list,
+            "in_reply_to": in_reply_to,
+            "sender": sender,
+            "recipients": recipients,
+            "date_header": date,
+            "date": parsed_date,
+            "subject": subject,
+            "body": self._get_body(message),
+            "attachments": self._get_attachments(message)
+        }
+
+
+    def _load_known_ids(self, session):
+
+        known_ids = set()
+
+        for (email_id,) in session.query(Email.id).yield_per(50000):
+            known_ids.add(email_id)
+
+        return known_ids
+
+
+    def _check_headers(self, headers):
+        """ Return the Message-ID of a header-only parsed message, or None if it is already stored or filtered out. """
+
+        message_id = headers.get("Message-ID", None)
+        if not message_id or (self.known_ids and message_id in self.known_ids):
+            return None
+
+        if self.since or self.until:
+
+            date = headers.get("Date")
+
+            try:
+                parsed_date = self._as_utc(parsedate_to_datetime(date)) if date else None
+            except Exception:
+                parsed_date = None
+
+            # messages without a usable date are kept
+            if parsed_date:
+                if self.since and parsed_date < self.since:
+                    return None
+                if self.until and parsed_date >= self.until:
+                    return None
+
+        if self.from_filter:
+            sender = self._decode_header_value(headers.get("From", ""))
+            if self.from_filter not in sender.lower():
+                return None
+
+        return message_id
+
+
+    def _as_utc(self, value):
+
+        if value is None or value.tzinfo is not None:
+            return value
+
+        return value.replace(tzinfo=timezone.utc)
+
+
+    def _decode_header_value(self, value: str) -> str:
+
+        try:
+            decoded_parts = decode_header(value)
+            return str(make_header(decoded_parts))
+        except Exception as e:
+            print(f"[WARN] Failed to decode header: {value}\nReason: {e}")
+            return value
+
+
+    def _build_thread_id(self, message):
+
+        references = message.get("References", None)
+        in_reply_to = message.get("In-Reply-To", None)
+        message_id = message.get("Message-ID", None)
+
+        if references:
+            ref_ids = references.split()
+            thread_id = ref_ids[0]
+        elif in_reply_to:
+            thread_id = in_reply_to
+        else:
+            thread_id = message_id
+
+        return thread_id
+
+
+    def _get_body(self, message) -> str:
+        """ Extract plain text body from the email. """
+
+        plain_text = ""
+        html_text = ""
+
+        if message.is_multipart():
+
+            for part in message.walk():
+
+                content_type = part.get_content_type()
+                content_disposition = str(part.get("Content-Disposition", "")).lower()
+
+                if "attachment" in content_disposition:
+                    continue  # Skip attachments
+
+                try:
+                    payload = part.get_payload(decode=True)
+                    if not payload:
+                        continue
+
+                    charset = part.get_content_charset() or "utf-8"
+                    text = payload.decode(charset, errors="ignore")
+
+                    if content_type == "text/plain":
+                        plain_text += text
+                    elif content_type == "text/html":
+                        html_text += text
+
+                except Exception:
+                    continue
+        else:
+
+            try:
+                payload = message.get_payload(decode=True)
+                if payload:
+                    charset = message.get_content_charset() or "utf-8"
+                    text = payload.decode(charset, errors="ignore")
+                    content_type = message.get_content_type()
+                    if content_type == "text/plain":
+                        plain_text = text
+                    elif content_type == "text/html":
+                        html_text = text
+            except Exception:
+                pass
+
+        if html_text:
+            status, output = self.html_to_text(html_text)
+            if status and output:
+                plain_text = output
+
+        return plain_text.replace('\x00', '').strip()
+
+
+    def _get_attachments(self, message) -> dict:
+
+        attachments = {}
+
+        if not message.is_multipart():
+            return attachments
+
+        for part in message.walk():
+
+            content_disposition = str(part.get("Content-Disposition", ""))
+
+            if "attachment" in content_disposition:
+
+                filename = part.get_filename()
+                if not filename:
+                    continue
+
+                try:
+                    binary_data = part.get_payload(decode=True) or b""
+                    mime_type = part.get_content_type()
+                    attachments[filename] = self.extract_attachment(mime_type, filename, binary_data)
+                except Exception:
+                    continue
+
+        return attachments
+
+
+    def extract_attachment(self, mime_type, filename, binary_data):
+
+        effective_mime = self.get_mime_type(mime_type, filename, binary_data)
+
+        # identical attachments (logos, forwarded PDFs) are extracted only once
+        content_hash = attachment_cache.content_hash(binary_data)
+
+        text_data = attachment_cache.get(content_hash, EXTRACTOR_VERSION)
+
+        content = None
+
+        if text_data is not None:
+            status = "done"
+        elif self.defer_extraction:
+            # raw bytes are only stored for attachments the extraction worker will actually extract
+            status = attachment_extractor.check(effective_mime, len(binary_data)) or "pending"
+            if status == "pending":
+                content = binary_data
+        else:
+            # runs in a separate process with size, page, output and time limits
+            status, text_data = attachment_extractor.extract(effective_mime, binary_data)
+            if status == "done":
+                attachment_cache.put(content_hash, EXTRACTOR_VERSION, effective_mime, text_data)
+            elif status in ("timeout", "failed", "too_large"):
+                print(f"[WARN] Attachment '{filename}' ({effective_mime}, {len(binary_data)} bytes) not extracted: {status}")
+
+        return {
+            "mime_type": effective_mime,
+            "extension": self.get_file_extension(filename),
+            "size": len(binary_data),
+            "text": text_data,
+            "content_hash": content_hash,
+            "status": status,
+            "content": content
+        }
+
+
     def get_mime_type(self, mime_type, filename, binary_data):
 
         try:
@@ -43,90 +397,64 @@ class Email_loader():
         return os.path.splitext(filename)[-1].lower()
 
 
-    def extract_text(self, effective_mime, binary_data):
+    def extract_text(self, effective_mime, binary_data, max_pages=None, max_chars=None):
+
+        try:
+            text_data = self.extract_text_strict(effective_mime, binary_data, max_pages, max_chars)
+        except Exception as e:
+            print(f"Error: extract_text: {e}")
+            text_data = ""
+
+        return text_data
+
+
+    def extract_text_strict(self, effective_mime, binary_data, max_pages=None, max_chars=None):
+        """ Same as extract_text(), but parser errors are raised instead of being swallowed. """
 
         text_data = ""
 
         if effective_mime in ["text/csv", "text/plain", "application/x-wine-extension-ini"]:
 
-            try:
-                text_data = binary_data.decode("utf-8", errors="ignore")
-            except Exception as e:
-                print(f"Error: extract_text: {e}")
-                pass
+            text_data = binary_data.decode("utf-8", errors="ignore")
 
         elif effective_mime == "application/json":
 
-            try:
-                json_str = binary_data.decode("utf-8")
-                parsed = json.loads(json_str)
-                text_data = json.dumps(parsed, indent=2)
-            except Exception as e:
-                print(f"Error: extract_text: {e}")
-                pass
+            json_str = binary_data.decode("utf-8")
+            parsed = json.loads(json_str)
+            text_data = json.dumps(parsed, indent=2)
 
         elif effective_mime == "text/html":
 
-            try:
-                html_txt = binary_data.decode('utf-8', errors='ignore')
-                status, output = self.html_to_text(html_txt)
-                if status and output:
-                    text_data = output
-            except Exception as e:
-                print(f"Error: extract_text: {e}")
-                pass
+            html_txt = binary_data.decode('utf-8', errors='ignore')
+            status, output = self.html_to_text(html_txt)
+            if not status:
+                raise ValueError(output)
+            text_data = output or ""
 
         elif effective_mime == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
 
-            try:
-                doc = Document(BytesIO(binary_data))
-                text_data = "\n".join([para.text for para in doc.paragraphs])
-            except Exception as e:
-                print(f"Error: extract_text: {e}")
-                pass
+            doc = Document(BytesIO(binary_data))
+            text_data = "\n".join([para.text for para in doc.paragraphs])
 
         elif effective_mime == "message/rfc822":
 
-            try:
-                parsed = self.parse_rfc822_email(binary_data)
-
-                text_data = ""
-                text_data += f"From: {parsed['sender']}\n"
-                text_data += f"To: {parsed['receiver']}\n"
-                text_data += f"Subject: {parsed['subject']}\n"
-                text_data += f"\n"
-                text_data += f"{parsed['body']}"
-            except Exception as e:
-                print(f"Error: extract_text: {e}")
-                pass
+            parsed = self.parse_rfc822_email(binary_data)
+            text_data = self.format_rfc822_email(parsed)
 
         elif effective_mime == "application/pdf":
 
-            try:
-                with pdfplumber.open(BytesIO(binary_data)) as pdf:
-                    all_text = "\n".join(page.extract_text() or "" for page in pdf.pages)
-                text_data = all_text.strip()
-            except Exception as e:
-                print(f"Error: extract_text: {e}")
-                pass
+            all_text = self.join_text(self.iter_pdf_text(BytesIO(binary_data), max_pages), max_chars)
+            text_data = all_text.strip()
 
         elif effective_mime in ["image/jpeg", "image/png"]:
 
-            try:
-                image = Image.open(BytesIO(binary_data))
-                text = pytesseract.image_to_string(image)
-                text_data = text.strip()
-            except Exception as e:
-                print(f"Error: extract_text: {e}")
-                pass
+            image = Image.open(BytesIO(binary_data))
+            text = pytesseract.image_to_string(image)
+            text_data = text.strip()
 
         elif effective_mime == "application/zip":
 
-            try:
-                text_data = self.extract_text_from_zip_binary(binary_data)
-            except Exception as e:
-                print(f"Error: extract_text: {e}")
-                pass
+            text_data = self.extract_text_from_zip_binary(binary_data, max_chars)
 
         else:
 
@@ -137,7 +465,10 @@ class Email_loader():
 
     def parse_rfc822_email(self, content):
 
-        msg = message_from_bytes(content, policy=default)
+        if hasattr(content, "read"):
+            msg = message_from_binary_file(content, policy=default)
+        else:
+            msg = message_from_bytes(content, policy=default)
 
         sender = msg.get("From")
         receiver = msg.get("To")
@@ -160,29 +491,131 @@ class Email_loader():
         }
 
 
-    def extract_text_from_zip_binary(self, binary_data):
+    def format_rfc822_email(self, parsed):
+
+        text_data = ""
+        text_data += f"From: {parsed['sender']}\n"
+        text_data += f"To: {parsed['receiver']}\n"
+        text_data += f"Subject: {parsed['subject']}\n"
+        text_data += f"\n"
+        text_data += f"{parsed['body']}"
+
+        return text_data
+
+
+    def extract_text_from_zip_binary(self, binary_data, max_chars=None):
+
+        text_data = self.join_text(self.iter_zip_text(BytesIO(binary_data)), max_chars)
+
+        return text_data.strip()
+
+
+    def iter_zip_text(self, fileobj, depth=0):
+        """ Yield the text of a zip archive member by member, recursing into nested .zip and .eml files. """
+
+        first = True
+
+        with zipfile.ZipFile(fileobj) as zip_file:
+
+            for info in zip_file.infolist():
+
+                file_name = info.filename
+                lower_name = file_name.lower()
+
+                if info.is_dir():
+                    continue
+
+                is_text = lower_name.endswith(zip_text_extensions)
+                is_nested = lower_name.endswith((".zip", ".eml")) and depth < config.extraction_max_depth
+
+                if not is_text and not is_nested:
+                    continue
+
+                if info.file_size > config.extraction_max_input_bytes:
+                    continue
 
-        result = []
+                separator = "" if first else "\n\n"
+                first = False
 
-        with zipfile.ZipFile(BytesIO(binary_data)) as zip_file:
+                yield f"{separator}===== {file_name} =====\n"
 
-            for file_name in zip_file.namelist():
+                try:
 
-                if file_name.lower().endswith((".txt", ".log", ".md", ".csv", ".json", ".yaml", ".yml")):
+                    with zip_file.open(info) as f:
 
-                    with zip_file.open(file_name) as f:
+                        if is_text:
+                            # decode in blocks, the member is never held in memory as a whole
+                            decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+                            for block in iter(lambda: f.read(64 * 1024), b""):
+                                yield decoder.decode(block)
+                            yield decoder.decode(b"", final=True)
+                            continue
 
-                        try:
-                            text = f.read().decode("utf-8", errors="ignore")
-                            result.append(f"===== {file_name} =====\n{text}")
-                        except Exception as e:
-                            result.append(f"===== {file_name} =====\n[Could not read file: {e}]")
+                        # nested archives need a seekable file, spill large ones to disk
+                        with tempfile.SpooledTemporaryFile(max_size=config.extraction_spool_bytes) as spool:
 
-        return "\n\n".join(result).strip()
+                            shutil.copyfileobj(f, spool)
+                            spool.seek(0)
+
+                            if lower_name.endswith(".zip"):
+                                yield from self.iter_zip_text(spool, depth + 1)
+                            else:
+                                yield self.format_rfc822_email(self.parse_rfc822_email(spool))
+
+                except Exception as e:
+                    yield f"[Could not read file: {e}]"
+
+
+    def iter_pdf_text(self, fileobj, max_pages=None):
+        """ Yield the text of a PDF page by page, releasing each page once it is read. """
+
+        with pdfplumber.open(fileobj) as pdf:
+
+            for idx, page in enumerate(pdf.pages):
+
+                if max_pages and idx >= max_pages:
+                    break
+
+                text = page.extract_text() or ""
+                page.close()
+
+                yield text if idx == 0 else "\n" + text
+
+
+    def join_text(self, chunks, max_chars=None):
+        """ Concatenate text chunks from a generator and stop reading once max_chars is reached. """
+
+        parts = []
+        total = 0
+
+        with closing(chunks):
+
+            for chunk in chunks:
+
+                if max_chars and total + len(chunk) >= max_chars:
+                    parts.append(chunk[:max_chars - total])
+                    break
+
+                parts.append(chunk)
+                total += len(chunk)
+
+        return "".join(parts)
 
 
     def html_to_text(self, html_text):
 
+        converter = self.html_converter or config.html_converter
+
+        if converter == "lxml" and lxml_html is not None:
+            status, output = self.html_to_text_lxml(html_text)
+            if status:
+                return status, output
+
+        return self.html_to_text_html2text(html_text)
+
+
+    def html_to_text_html2text(self, html_text):
+
         try:
 
             h = html2text.HTML2Text()
@@ -197,17 +630,64 @@ class Email_loader():
 
             text = h.handle(html_text)
 
-            # Remove invisible or formatting Unicode characters
-            text = re.sub(r"[\u200c\u200d\u200e\u200f\u202a-\u202e\u2060-\u206f\u00ad\xa0]", " ", text)
+            return True, self.normalize_text(text)
 
-            # Replace multiple consecutive spaces or tabs with a single space
-            text = re.sub(r"[ \t]+", " ", text)
+        except Exception as E:
+
+            return False, f"Error in parsing html: {str(E)}"
+
+
+    def html_to_text_lxml(self, html_text):
+
+        try:
+
+            if not html_text.strip():
+                return True, ""
+
+            # parse from bytes, lxml rejects str input that carries an encoding declaration
+            doc = lxml_html.document_fromstring(html_text.encode("utf-8", errors="ignore"), parser=lxml_parser)
+
+            etree.strip_elements(doc, etree.Comment, "script", "style", "head", "noscript", with_tail=False)
+
+            # text_content() drops all markup, so put the line structure back first
+            for el in doc.iter(*html_paragraph_tags):
+                el.text = "\n\n" + (el.text or "")
+                el.tail = "\n\n" + (el.tail or "")
+
+            for el in doc.iter(*html_line_tags):
+                el.tail = "\n" + (el.tail or "")
 
-            # Normalize newlines (remove lines that are empty or have only whitespace)
-            text = re.sub(r"\n\s*\n+", "\n\n", text)
+            for el in doc.iter("td", "th"):
+                el.tail = " " + (el.tail or "")
 
-            return True, text.strip()
+            return True, self.normalize_text(doc.text_content())
 
         except Exception as E:
 
             return False, f"Error in parsing html: {str(E)}"
+
+
+    def normalize_text(self, text):
+
+        # Remove invisible or formatting Unicode characters
+        text = invisible_chars_re.sub(" ", text)
+
+        # Replace multiple consecutive spaces or tabs with a single space
+        text = spaces_re.sub(" ", text)
+
+        # Normalize newlines (remove lines that are empty or have only whitespace)
+        text = blank_lines_re.sub("\n\n", text)
+
+        return text.strip()
+
+
+#################
+
+def init_parser_worker():
+    """ Setup shared by the parser pool processes of the mbox and Maildir loaders. """
+
+    # connections inherited from the parent must not be shared across processes
+    engine.dispose(close=False)
+
+    # the parser pool already spreads work across cores
+    attachment_extractor.workers = 1
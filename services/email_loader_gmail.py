@@ -2,37 +2,83 @@
 import sys
 import os
 import uuid
+import time
 import pickle
-from datetime import datetime
-from datetime import timezone
+import threading
+from datetime import datetime, timedelta, timezone
 from base64 import urlsafe_b64decode
+from concurrent.futures import ThreadPoolExecutor
 
+from email import message_from_bytes
 from email.utils import parsedate_to_datetime
 from email.utils import getaddresses
 
+import httplib2
+import requests
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 
+from sqlalchemy import desc
+from sqlalchemy import update
+from sqlalchemy import bindparam
+
+import config
 from db.session import SessionLocal
-from db.models import Email, Attachment
+from db.models import Email, SyncState
+from db.bulk_writer import Bulk_writer
 from services.email_loader import Email_loader
+from services.poll_scheduler import Token_bucket
+
+# Gmail API quota cost per call
+QUOTA_UNITS = {
+    "messages.get": 5,
+    "messages.list": 5,
+    "attachments.get": 5,
+    "history.list": 2,
+    "getProfile": 1,
+}
 
 
 class Email_loader_Gmail(Email_loader):
 
     SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
-    def __init__(self):
+    TOKEN_FILE = "token.pickle"
+    CREDENTIAL_FILE = "credentials.json"
+
+    def __init__(self, defer_extraction=False, credentials=None, fetch_format=None):
+        """ Build once and reuse across polls: credentials, the service object and HTTP connections are kept. """
+
+        self.defer_extraction = defer_extraction
+        self.fetch_format = fetch_format or config.gmail_fetch_format
+
+        # token refreshes go over one pooled HTTPS session
+        self.auth_request = Request(requests.Session())
+        self.credentials = credentials or self.get_credentials()
+
+        self.batch_uri = config.gmail_api_root + "batch/gmail/v1"
+        self.local = threading.local()
+        self.quota = Token_bucket(config.gmail_quota_units_per_second, name="gmail")
 
-        self.service = self.get_gmail_service()
+        # batch threads live as long as the loader, so their connections are reused across polls
+        self.executor = ThreadPoolExecutor(max_workers=config.gmail_batch_concurrency)
 
+        # the discovery document bundled with the client library, no network fetch
+        self.service = build('gmail', 'v1',
+                             http=AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=60)),
+                             static_discovery=True,
+                             client_options={"api_endpoint": config.gmail_api_root})
 
-    def get_gmail_service(self):
+
+    def get_credentials(self):
 
         creds = None
-        token_file = "token.pickle"
-        credential_file = "credentials.json"
+        token_file = self.TOKEN_FILE
+        credential_file = self.CREDENTIAL_FILE
 
         if os.path.exists(token_file):
 
@@ -45,7 +91,7 @@ class Email_loader_Gmail(Email_loader):
                 # Refresh if possible
                 if creds.expired and creds.refresh_token:
                     try:
-                        creds.refresh(Request())
+                        creds.refresh(self.auth_request)
                         print("Token refreshed successfully.")
                         # Save updated token
                         with open(token_file, 'wb') as tfu:
@@ -75,23 +121,119 @@ class Email_loader_Gmail(Email_loader):
             with open(token_file, 'wb') as tf:
                 pickle.dump(creds, tf)
 
-        return build('gmail', 'v1', credentials=creds)
+        return creds
 
 
-    def load_emails(self, since=None, query="", max_results=50, batch_size=5):
+    def refresh_credentials(self):
+        """ Refresh the access token only when it is about to expire. """
 
-        print("Getting a list of emails from Gmail...")
+        creds = self.credentials
 
-        header_map = self.get_email_list(since, query, max_results)
-        if not header_map:
+        # anonymous credentials (fake server) have nothing to refresh
+        if not getattr(creds, "refresh_token", None):
             return
 
-        print(f"Found '{len(header_map)}' new emails.")
+        margin = timedelta(seconds=config.gmail_token_refresh_margin)
+        if creds.valid and creds.expiry and creds.expiry - datetime.utcnow() > margin:
+            return
 
-        self.save_to_db(header_map, batch_size)
+        creds.refresh(self.auth_request)
+        print("Token refreshed successfully.")
 
+        with open(self.TOKEN_FILE, 'wb') as tf:
+            pickle.dump(creds, tf)
 
-    def get_email_list(self, since, query, max_results):
+
+    def sync(self, query="", batch_size=50):
+        """ Store new INBOX messages. Uses the Gmail history since the last sync, or a full listing when there is none.
+        Returns the number of new messages stored. """
+
+        self.refresh_credentials()
+
+        session = SessionLocal()
+        state = session.get(SyncState, "gmail")
+        history_id = state.history_id if state else None
+        latest_email = session.query(Email.date).order_by(desc(Email.date)).first()
+        session.close()
+
+        messages = None
+
+        if history_id:
+            messages, new_history_id = self.get_history_messages(history_id)
+
+        if messages is None:
+            # taken before listing, so messages that arrive meanwhile show up in the next history read
+            self.quota.consume(QUOTA_UNITS["getProfile"])
+            new_history_id = self.service.users().getProfile(userId='me').execute()["historyId"]
+            since = latest_email[0] if latest_email else None
+            print(f"Listing Gmail messages since: {since}")
+            messages = self.list_messages(since, query)
+
+        messages = self.filter_known_messages(messages)
+
+        stored = 0
+        failed = 0
+
+        if messages and self.fetch_format == "raw":
+            print(f"Found '{len(messages)}' new emails.")
+            stored, failed = self.save_raw_to_db(messages, batch_size)
+
+        elif messages:
+            header_map, failed = self.get_msg_header(messages)
+            header_map = dict(sorted(header_map.items(), key=lambda item: item[1]["internalDate"]))
+            print(f"Found '{len(header_map)}' new emails.")
+            stored, save_failed = self.save_to_db(header_map, batch_size)
+            failed += save_failed
+
+        # messages that could not be fetched are read again from the same history position
+        if failed:
+            print(f"[WARN] {failed} Gmail messages could not be fetched, keeping historyId {history_id}")
+            return stored
+
+        session = SessionLocal()
+        session.merge(SyncState(source="gmail", history_id=str(new_history_id), updated_at=datetime.utcnow()))
+        session.commit()
+        session.close()
+
+        return stored
+
+
+    def get_history_messages(self, start_history_id):
+        """ Messages added to the INBOX after start_history_id. Returns (messages, latest history id), or (None, None) once the id has expired. """
+
+        messages = {}
+        page_token = None
+
+        while True:
+
+            self.quota.consume(QUOTA_UNITS["history.list"])
+
+            try:
+                response = self.service.users().history().list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded'],
+                    labelId='INBOX',
+                    pageToken=page_token
+                ).execute()
+            except HttpError as e:
+                if e.resp.status == 404:
+                    print(f"[WARN] Gmail historyId {start_history_id} has expired, falling back to a full listing")
+                    return None, None
+                raise
+
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    message = added['message']
+                    if 'INBOX' in message.get('labelIds', ['INBOX']):
+                        messages[message['id']] = message
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return list(messages.values()), response['historyId']
+
+
+    def list_messages(self, since=None, query="", max_results=None):
 
         if not query:
             query = ""
@@ -101,16 +243,63 @@ class Email_loader_Gmail(Email_loader):
 
         query = query.strip()
 
-        response = self.service.users().messages().list(
-            userId='me',
-            q=query,
-            labelIds=['INBOX'],
-            maxResults=max_results
-        ).execute()
+        messages = []
+        page_token = None
+
+        while True:
+
+            self.quota.consume(QUOTA_UNITS["messages.list"])
+
+            response = self.service.users().messages().list(
+                userId='me',
+                q=query,
+                labelIds=['INBOX'],
+                maxResults=min(max_results or 500, 500),
+                pageToken=page_token
+            ).execute()
 
-        messages = response.get('messages', [])
+            messages.extend(response.get('messages', []))
 
-        header_map = self.get_msg_header(messages)
+            page_token = response.get('nextPageToken')
+            if not page_token or (max_results and len(messages) >= max_results):
+                return messages[:max_results] if max_results else messages
+
+
+    def filter_known_messages(self, messages):
+
+        if not messages:
+            return messages
+
+        session = SessionLocal()
+        ids = [msg['id'] for msg in messages]
+        known = set()
+
+        for i in range(0, len(ids), 5000):
+            known.update(row[0] for row in session.query(Email.gmail_id).filter(Email.gmail_id.in_(ids[i:i + 5000])))
+
+        session.close()
+
+        return [msg for msg in messages if msg['id'] not in known]
+
+
+    def load_emails(self, since=None, query="", max_results=50, batch_size=50):
+
+        print("Getting a list of emails from Gmail...")
+
+        header_map = self.get_email_list(since, query, max_results)
+        if not header_map:
+            return
+
+        print(f"Found '{len(header_map)}' new emails.")
+
+        self.save_to_db(header_map, batch_size)
+
+
+    def get_email_list(self, since, query, max_results):
+
+        messages = self.filter_known_messages(self.list_messages(since, query, max_results))
+
+        header_map, _ = self.get_msg_header(messages)
 
         # Sort by internalDate (oldest first)
         sorted_map = dict(
@@ -134,12 +323,22 @@ class Email_loader_Gmail(Email_loader):
 
 
     def get_msg_header(self, messages):
+        """ Returns (header map, number of messages whose metadata could not be fetched this time). """
 
         msg_dict = {}
 
-        for msg in messages:
+        requests = {
+            msg['id']: self.service.users().messages().get(userId='me', id=msg['id'], format='metadata')
+            for msg in messages
+        }
+
+        responses = self.execute_batch(requests)
 
-            metadata = self.service.users().messages().get(userId='me', id=msg['id'], format='metadata').execute()
+        for _id, metadata in responses.items():
+
+            if metadata is None:
+                print(f"[WARN] Gmail message {_id} cannot be fetched, skipped")
+                continue
 
             headers = metadata.get('payload', {}).get('headers', [])
 
@@ -153,80 +352,316 @@ class Email_loader_Gmail(Email_loader):
 
             msg_dict[metadata["id"]] = dict(sorted(header_map.items()))
 
-        return msg_dict
+        return msg_dict, len(requests) - len(responses)
 
 
     def save_to_db(self, header_map, batch_size):
+        """ Fetch and store the given messages. Returns (number of emails stored, number of failed fetches). """
 
         new_email_count = len(header_map)
-        batch_counter = 0
         session = SessionLocal()
+        writer = Bulk_writer(session, max_rows=batch_size)
 
-        for idx, (_id, message_header) in enumerate(header_map.items()):
+        # one set-based lookup instead of a SELECT per message
+        message_ids = [h.get("message-id") for h in header_map.values() if h.get("message-id")]
+        known_ids = {
+            row[0] for row in session.query(Email.id).filter(Email.id.in_(message_ids))
+        } if message_ids else set()
 
-            message_id = message_header.get("message-id")
+        self.backfill_gmail_ids(session, [
+            (_id, h["message-id"]) for _id, h in header_map.items() if h.get("message-id") in known_ids
+        ])
+
+        new_ids = []
+        stored = 0
+        failed = 0
 
-            if session.query(Email).filter_by(id=message_id).first():
+        for _id, message_header in header_map.items():
+            message_id = message_header.get("message-id")
+            if message_id in known_ids:
                 continue
+            if message_id:
+                known_ids.add(message_id)
+            new_ids.append(_id)
 
-            print(f"\n({idx+1}/{new_email_count}) Processing new email:")
-            print(f"  Date: {message_header.get('date', '')}")
-            print(f"  Subject: {message_header.get('subject', '')}")
-            print(f"  From: {message_header.get('from', '')}")
-
-            msg_info = self.parse_email(_id, message_header)
-
-            message_id = msg_info["message_id"]
-            thread_id = msg_info["thread_id"]
-            references = msg_info["references"]
-            in_reply_to = msg_info["in_reply_to"]
-            sender = msg_info["sender"]
-            recipients = msg_info["recipients"]
-            date = msg_info["date"]
-            subject = msg_info["subject"]
-            body = msg_info["body"]
-            attachments = msg_info["attachments"]
-
-            email_obj = Email(
-                id=message_id,
-                thread_id=thread_id,
-                references=references,
-                in_reply_to=in_reply_to,
-                sender=sender,
-                recipients=recipients,
-                date=date or datetime.utcnow(),
-                subject=subject,
-                body=body
-            )
-            session.add(email_obj)
+        # full messages and their attachments are fetched in batches, enough to keep every batch slot busy
+        chunk_size = config.gmail_batch_size * config.gmail_batch_concurrency
+        positions = {_id: idx for idx, _id in enumerate(header_map)}
 
-            for filename, meta in attachments.items():
+        for start in range(0, len(new_ids), chunk_size):
+
+            chunk = new_ids[start:start + chunk_size]
+
+            full_messages = self.fetch_messages(chunk, "full")
+            attachment_data = self.fetch_attachments(full_messages.values())
+
+            for _id in chunk:
+
+                message_header = header_map[_id]
+
+                print(f"\n({positions[_id]+1}/{new_email_count}) Processing new email:")
+                print(f"  Date: {message_header.get('date', '')}")
+                print(f"  Subject: {message_header.get('subject', '')}")
+                print(f"  From: {message_header.get('from', '')}")
+
+                if _id not in full_messages:
+                    print(f"[WARN] Could not fetch Gmail message {_id}, it will be retried on the next poll")
+                    failed += 1
+                    continue
+
+                full = full_messages[_id]
+                if full is None:
+                    print(f"[WARN] Gmail message {_id} cannot be fetched, skipped")
+                    continue
+
+                # stored without an attachment, the message would never be fetched again
+                if any((_id, attachment_id) not in attachment_data for attachment_id in self.get_attachment_ids(full)):
+                    print(f"[WARN] Could not fetch all attachments of Gmail message {_id}, it will be retried on the next poll")
+                    failed += 1
+                    continue
 
-                attachment = Attachment(
-                    id=str(uuid.uuid4()),
-                    email_id=message_id,
-                    filename=filename,
-                    mime_type=meta.get("mime_type"),
-                    extension=meta.get("extension"),
-                    size=meta.get("size"),
-                    text_content=meta.get("text")
-                )
-                session.add(attachment)
+                msg_info = self.parse_email(_id, message_header, full, attachment_data)
 
-            batch_counter += 1
+                email_row, attachment_rows = self.build_rows(msg_info)
 
-            if batch_counter >= batch_size:
-                session.commit()
-                batch_counter = 0
+                if writer.add(email_row, attachment_rows):
+                    stored += writer.flush()
+                    session.commit()
 
         # Final commit for remaining
-        if batch_counter > 0:
-            session.commit()
+        stored += writer.flush()
+        session.commit()
 
         session.close()
 
+        return stored, failed
 
-    def parse_email(self, _id, message_header):
+
+    def save_raw_to_db(self, messages, batch_size):
+        """ Fetch messages with format='raw' and parse them with the same MIME code as the mbox loader.
+        Returns (number of emails stored, number of failed fetches). """
+
+        session = SessionLocal()
+        writer = Bulk_writer(session, max_rows=batch_size)
+        stored = 0
+        failed = 0
+        idx = 0
+
+        chunk_size = config.gmail_batch_size * config.gmail_batch_concurrency
+
+        for start in range(0, len(messages), chunk_size):
+
+            chunk = [msg['id'] for msg in messages[start:start + chunk_size]]
+
+            raw_messages = self.fetch_messages(chunk, "raw")
+            failed += len(chunk) - len(raw_messages)
+
+            records = []
+
+            for _id, raw in raw_messages.items():
+                if raw is None:
+                    print(f"[WARN] Gmail message {_id} cannot be fetched, skipped")
+
+            found = [raw for raw in raw_messages.values() if raw is not None]
+
+            for raw in sorted(found, key=lambda m: int(m.get("internalDate", 0))):
+
+                try:
+                    record = self._parse_message(message_from_bytes(urlsafe_b64decode(raw['raw'])))
+                except Exception as e:
+                    # retrying would fail the same way, skip it instead of stopping the sync
+                    print(f"[WARN] Gmail message {raw['id']} cannot be parsed, skipped: {e}")
+                    continue
+
+                if record is None:
+                    print(f"[WARN] Gmail message {raw['id']} has no Message-ID, skipped")
+                    continue
+
+                # a missing or malformed Date header falls back to the time Gmail received the message
+                if record["date"] is None and raw.get("internalDate"):
+                    record["date"] = datetime.fromtimestamp(int(raw["internalDate"]) / 1000, tz=timezone.utc)
+
+                # Gmail's own thread grouping, as in the 'full' fetch
+                record["thread_id"] = raw.get("threadId") or record["thread_id"]
+                record["gmail_id"] = raw["id"]
+                records.append(record)
+
+            message_ids = [record["id"] for record in records]
+            known_ids = {
+                row[0] for row in session.query(Email.id).filter(Email.id.in_(message_ids))
+            } if message_ids else set()
+
+            self.backfill_gmail_ids(session, [(r["gmail_id"], r["id"]) for r in records if r["id"] in known_ids])
+
+            for record in records:
+
+                idx += 1
+
+                if record["id"] in known_ids or writer.contains(record["id"]):
+                    continue
+
+                print(f"\n({idx}/{len(messages)}) Processing new email:")
+                print(f"  Date: {record['date_header']}")
+                print(f"  Subject: {record['subject']}")
+                print(f"  From: {record['sender']}")
+
+                email_row, attachment_rows = self.build_rows(record)
+
+                if writer.add(email_row, attachment_rows):
+                    stored += writer.flush()
+                    session.commit()
+
+        stored += writer.flush()
+        session.commit()
+
+        session.close()
+
+        return stored, failed
+
+
+    def backfill_gmail_ids(self, session, pairs):
+        """ Set gmail_id on emails stored before gmail ids were recorded, so they are skipped without a fetch. """
+
+        if not pairs:
+            return
+
+        emails = Email.__table__
+        session.execute(
+            update(emails)
+            .where(emails.c.id == bindparam("message_id"), emails.c.gmail_id.is_(None))
+            .values(gmail_id=bindparam("new_gmail_id")),
+            [{"new_gmail_id": gmail_id, "message_id": message_id} for gmail_id, message_id in pairs])
+        session.commit()
+
+
+    def fetch_messages(self, ids, message_format):
+
+        requests = {
+            _id: self.service.users().messages().get(userId='me', id=_id, format=message_format)
+            for _id in ids
+        }
+
+        return self.execute_batch(requests)
+
+
+    def fetch_attachments(self, messages):
+        """ Download the attachments of the given full messages. Returns {(message id, attachment id): bytes}. """
+
+        requests = {}
+
+        for message in messages:
+            if message is None:
+                continue
+            for attachment_id in self.get_attachment_ids(message):
+                requests[(message["id"], attachment_id)] = self.service.users().messages().attachments().get(
+                    userId='me', messageId=message["id"], id=attachment_id)
+
+        # attachments that cannot be fetched for good map to None, the message is stored without them
+        return {
+            key: urlsafe_b64decode(attachment['data']) if attachment is not None else None
+            for key, attachment in self.execute_batch(requests, QUOTA_UNITS["attachments.get"]).items()
+        }
+
+
+    def get_attachment_ids(self, message):
+
+        attachment_ids = []
+
+        def collect(parts):
+            for part in parts:
+                if "parts" in part:
+                    collect(part["parts"])
+                attachment_id = part.get("body", {}).get("attachmentId")
+                if part.get("filename") and attachment_id:
+                    attachment_ids.append(attachment_id)
+
+        collect(message.get("payload", {}).get("parts", []))
+
+        return attachment_ids
+
+
+    def execute_batch(self, requests, units_per_request=QUOTA_UNITS["messages.get"], max_attempts=5):
+        """ Run {key: request} as Gmail batch HTTP calls, several in parallel. Returns {key: response}; requests that can never
+        succeed (e.g. a deleted message) map to None, requests that failed otherwise are left out. """
+
+        responses = {}
+        pending = list(requests.items())
+        batch_size = min(config.gmail_batch_size, 100)
+
+        for attempt in range(max_attempts):
+
+            if not pending:
+                break
+
+            if attempt:
+                # rate-limited sub-requests are retried with exponential backoff
+                time.sleep(2 ** attempt)
+
+            chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+            results = list(self.executor.map(self._execute_one_batch, chunks, [units_per_request] * len(chunks)))
+
+            pending = []
+
+            for chunk_responses, chunk_retry in results:
+                responses.update(chunk_responses)
+                pending.extend(chunk_retry)
+
+        for key, _ in pending:
+            print(f"[ERROR] Gmail request failed after {max_attempts} attempts: {key}")
+
+        return responses
+
+
+    def _execute_one_batch(self, items, units_per_request):
+
+        responses = {}
+        retry = []
+        request_keys = {str(i): key for i, (key, _) in enumerate(items)}
+        requests = dict(items)
+
+        def callback(request_id, response, exception):
+
+            key = request_keys[request_id]
+
+            if exception is None:
+                responses[key] = response
+            elif isinstance(exception, HttpError) and exception.resp.status in (429, 500, 502, 503, 504):
+                retry.append((key, requests[key]))
+            elif isinstance(exception, HttpError) and exception.resp.status in (400, 404):
+                # retrying would fail the same way, it must not hold back the historyId
+                print(f"[WARN] Gmail request {key} failed for good: {exception}")
+                responses[key] = None
+            else:
+                print(f"[WARN] Gmail request {key} failed: {exception}")
+
+        batch = BatchHttpRequest(callback=callback, batch_uri=self.batch_uri)
+
+        for request_id, (_, request) in zip(request_keys, items):
+            batch.add(request, request_id=request_id)
+
+        # every sub-request counts against the per-user quota
+        self.quota.consume(len(items) * units_per_request)
+
+        try:
+            batch.execute(http=self._get_http())
+        except Exception as e:
+            print(f"[WARN] Gmail batch request failed: {e}")
+            return responses, [item for item in items if item[0] not in responses]
+
+        return responses, retry
+
+
+    def _get_http(self):
+
+        # httplib2 connections are not thread-safe, each batch thread keeps its own
+        if not hasattr(self.local, "http"):
+            self.local.http = AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=60))
+
+        return self.local.http
+
+
+    def parse_email(self, _id, message_header, full, attachment_data):
 
         references_raw = message_header.get('references', '')
         references_list = references_raw.split() if references_raw else []
@@ -243,13 +678,13 @@ class Email_loader_Gmail(Email_loader):
             except Exception:
                 print(f"Error: parsing email date: {date_str}")
 
-        full = self.service.users().messages().get(userId='me', id=_id, format='full').execute()
         payload = full.get('payload', {})
         body = self.extract_body(payload)
-        attachments = self.extract_attachments(full)
+        attachments = self.extract_attachments(full, attachment_data)
 
         return {
-            "message_id": message_header.get('message-id', str(uuid.uuid4())),
+            "id": message_header.get('message-id', str(uuid.uuid4())),
+            "gmail_id": _id,
             "thread_id": message_header.get('threadId'),
             "references": references_list,
             "in_reply_to": message_header.get('in-reply-to'),
@@ -315,7 +750,7 @@ class Email_loader_Gmail(Email_loader):
         return text_plain.replace('\x00', '').strip()
 
 
-    def extract_attachments(self, message):
+    def extract_attachments(self, message, attachment_data):
 
         attachments = {}
 
@@ -335,26 +770,12 @@ class Email_loader_Gmail(Email_loader):
                 if not filename or not attachment_id:
                     continue
 
-                # Download attachment
-                attachment = self.service.users().messages().attachments().get(
-                    userId='me', messageId=msg_id, id=attachment_id
-                ).execute()
-
-                # Decode attachment
-                binary_data = urlsafe_b64decode(attachment['data'])
-
-                effective_mime = self.get_mime_type(mime_type, filename, binary_data)
-
-                text_data = self.extract_text(effective_mime, binary_data)
-
-                ext = self.get_file_extension(filename)
+                # Downloaded by fetch_attachments()
+                binary_data = attachment_data.get((msg_id, attachment_id))
+                if binary_data is None:
+                    continue
 
-                attachments[filename] = {
-                    "mime_type": effective_mime,
-                    "extension": ext,
-                    "size": len(binary_data),
-                    "text": text_data
-                }
+                attachments[filename] = self.extract_attachment(mime_type, filename, binary_data)
 
         if "parts" in message["payload"]:
             process_parts(message["payload"]["parts"], message["id"])
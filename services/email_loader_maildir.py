@@ -0,0 +1,228 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from email import message_from_bytes
+from email.parser import BytesHeaderParser
+from sqlalchemy.dialects.postgresql import insert
+
+from db.session import SessionLocal
+from db.models import MailFile
+from db.bulk_writer import Bulk_writer
+from services.email_loader import Email_loader
+from services.email_loader import init_parser_worker
+
+
+class Email_loader_maildir(Email_loader):
+    """ Load emails from Maildir trees and directories of exported .eml files. """
+
+    def __init__(self, root_path, workers=1, scan_threads=16, defer_extraction=False):
+
+        self.root_path = root_path
+        self.workers = max(1, workers)
+        self.scan_threads = max(1, scan_threads)
+        self.defer_extraction = defer_extraction
+
+        if not os.path.isdir(root_path):
+            print(f"Error: mail directory is not accessible: {root_path}")
+            sys.exit(2)
+
+
+    def load_emails(self, max_results=-1, batch_size=1000, files_per_task=256):
+
+        session = SessionLocal()
+        writer = Bulk_writer(session, max_rows=batch_size)
+        file_rows = []
+        skipped = 0
+
+        self.known_ids = self._load_known_ids(session)
+        known_files = self._load_known_files(session)
+        print(f"Loaded {len(self.known_ids)} stored message ids and {len(known_files)} scanned files.")
+
+        # path + size + mtime is a cheap dedup key, unchanged files are never opened
+        paths = []
+        for path, size, mtime in self._scan_directory(self.root_path):
+            if known_files.get(path) != (size, mtime):
+                paths.append((path, size, mtime))
+
+        if max_results != -1:
+            paths = paths[:max_results]
+
+        print(f"Found {len(paths)} new or changed mail files under {self.root_path}")
+
+        tasks = [paths[i:i + files_per_task] for i in range(0, len(paths), files_per_task)]
+
+        if self.workers > 1:
+            executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_maildir_worker, initargs=(self,))
+            results = self.iter_pool_results(executor, _parse_mail_files, tasks, self.workers * 2)
+        else:
+            executor = None
+            results = ((task, self._parse_files(task)) for task in tasks)
+
+        idx = 0
+
+        try:
+
+            for _, parsed in results:
+
+                for file_row, record in parsed:
+
+                    idx += 1
+                    file_rows.append(file_row)
+
+                    if record is None or record["id"] in self.known_ids:
+                        skipped += 1
+                        continue
+
+                    print(f"\n({idx}/{len(paths)}) Processing new email file: {file_row['path']}")
+                    print(f"  Date: {record['date_header']}")
+                    print(f"  Subject: {record['subject']}")
+                    print(f"  From: {record['sender']}")
+
+                    email_row, attachment_rows = self.build_rows(record)
+                    self.known_ids.add(record["id"])
+
+                    if writer.add(email_row, attachment_rows):
+                        self._flush(session, writer, file_rows)
+
+            self._flush(session, writer, file_rows)
+
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            session.close()
+
+        print(f"\nAll emails are processed! ({skipped} files skipped)")
+
+
+    def _scan_directory(self, root_path):
+        """ Walk the tree with os.scandir() on a thread pool, one directory per task. Yields (path, size, mtime). """
+
+        with ThreadPoolExecutor(max_workers=self.scan_threads) as executor:
+
+            pending = {executor.submit(self._scan_one, root_path)}
+
+            while pending:
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    files, subdirs = future.result()
+                    for subdir in subdirs:
+                        pending.add(executor.submit(self._scan_one, subdir))
+                    yield from files
+
+
+    def _scan_one(self, path):
+
+        files = []
+        subdirs = []
+
+        # Maildir: messages live in cur/ and new/, tmp/ holds deliveries in progress
+        dir_name = os.path.basename(path)
+        is_maildir_folder = dir_name in ("cur", "new")
+
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name != "tmp":
+                            subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        if entry.name.startswith("."):
+                            continue
+                        if is_maildir_folder or entry.name.lower().endswith(".eml"):
+                            stat = entry.stat(follow_symlinks=False)
+                            files.append((entry.path, stat.st_size, stat.st_mtime))
+        except OSError as e:
+            print(f"[WARN] Cannot scan directory {path}: {e}")
+
+        return files, subdirs
+
+
+    def _parse_files(self, files):
+
+        parsed = []
+
+        for path, size, mtime in files:
+
+            file_row = {"path": path, "size": size, "mtime": mtime, "email_id": None}
+
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except OSError as e:
+                print(f"[WARN] Cannot read mail file {path}: {e}")
+                parsed.append((file_row, None))
+                continue
+
+            # headers first, stored or filtered messages are never fully parsed
+            message_id = self._check_headers(BytesHeaderParser().parsebytes(data))
+            if not message_id:
+                parsed.append((file_row, None))
+                continue
+
+            try:
+                record = self._parse_message(message_from_bytes(data))
+            except Exception as e:
+                # recorded like an unreadable file, one broken message must not abort the import
+                print(f"[WARN] Cannot parse mail file {path}: {e}")
+                parsed.append((file_row, None))
+                continue
+
+            file_row["email_id"] = message_id
+
+            parsed.append((file_row, record))
+
+        return parsed
+
+
+    def _load_known_files(self, session):
+
+        known_files = {}
+
+        for path, size, mtime in session.query(MailFile.path, MailFile.size, MailFile.mtime).yield_per(50000):
+            known_files[path] = (size, mtime)
+
+        return known_files
+
+
+    def _flush(self, session, writer, file_rows):
+
+        inserted = writer.flush()
+
+        # file rows are recorded in the same transaction as their emails
+        for i in range(0, len(file_rows), 5000):
+            stmt = insert(MailFile).values(file_rows[i:i + 5000])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["path"],
+                set_={"size": stmt.excluded.size, "mtime": stmt.excluded.mtime, "email_id": stmt.excluded.email_id})
+            session.execute(stmt)
+
+        session.commit()
+        file_rows.clear()
+
+        if inserted:
+            print(f"\nStored {inserted} new emails.")
+
+
+#################
+
+# Per-process state of the maildir parser pool
+
+_worker_loader = None
+
+def _init_maildir_worker(loader):
+
+    global _worker_loader
+
+    init_parser_worker()
+
+    _worker_loader = loader
+
+
+def _parse_mail_files(files):
+
+    return _worker_loader._parse_files(files)
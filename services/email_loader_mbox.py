@@ -1,250 +1,612 @@
-
 import os
 import sys
-import uuid
-import io
+import time
+import mmap
+import gzip
+import lzma
+import zipfile
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-from email import message_from_binary_file
-from email.utils import parsedate_to_datetime
-from email.utils import parseaddr
-from email.header import decode_header, make_header
+from email import message_from_string
+from email.parser import HeaderParser
 
 from db.session import SessionLocal
-from db.models import Email, Attachment
+from db.models import MboxCheckpoint
+from db.bulk_writer import Bulk_writer
 from services.email_loader import Email_loader
+from services.email_loader import init_parser_worker
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+compressed_extensions = {
+    ".gz": "gzip",
+    ".xz": "xz",
+    ".zst": "zstd",
+    ".zip": "zip",
+}
 
 
 class Email_loader_mbox(Email_loader):
 
-    def __init__(self, mbox_path):
+    def __init__(self, mbox_path, workers=1, since=None, until=None, from_filter=None, defer_extraction=False):
 
         self.mbox_path = mbox_path
+        self.workers = max(1, workers)
+        self.defer_extraction = defer_extraction
+
+        # header-only prefilter, applied before any body is parsed
+        self.known_ids = None
+        self.since = self._as_utc(since)
+        self.until = self._as_utc(until)
+        self.from_filter = from_filter.lower() if from_filter else None
 
         if not os.path.exists(mbox_path):
             print(f"Error: mbox_path is not accessible: {mbox_path}")
             sys.exit(2)
 
+        # compressed mailboxes are decompressed on the fly, offsets refer to the decompressed stream
+        self.compression = compressed_extensions.get(os.path.splitext(mbox_path)[1].lower())
+
+        if self.compression == "zstd" and zstandard is None:
+            print(f"Error: the zstandard package is required to read {mbox_path}")
+            sys.exit(2)
+
+        self.checkpoint_key = self._get_checkpoint_key()
+
+        # byte offset and inode of the last processed message, used by follow()
+        self.offset = 0
+        self.inode = None
+
 
-    def load_emails(self, max_results=-1, batch_size=5):
+    def load_emails(self, max_results=-1, batch_size=1000, hold_tail=False, parallel_min_bytes=16*1024*1024):
 
         session = SessionLocal()
-        batch_counter = 0
+        writer = Bulk_writer(session, max_rows=batch_size)
 
-        for idx, message in enumerate(self._iter_mbox_stream()): # 78970
+        if self.compression:
+            mm = None
+            start_offset = self._load_stream_checkpoint(session)
+        else:
+            mm = self._map_mbox()
+            start_offset = self._load_checkpoint(session, mm)
 
-            if max_results != -1 and idx >= max_results:
-                break
+        last_end = start_offset
+        skipped = 0
+
+        if self.known_ids is None:
+            self.known_ids = self._load_known_ids(session)
+            print(f"Loaded {len(self.known_ids)} stored message ids.")
+
+        # also catches duplicates within the file that the worker snapshots of known_ids miss
+        is_known = self.known_ids.__contains__
+
+        # a pool only pays off for a large backlog, not for a few appended messages
+        use_pool = self.workers > 1 and mm is not None and len(mm) - start_offset >= parallel_min_bytes
+
+        if self.compression:
+            records = self._iter_stream_records(start_offset, max_results, is_known)
+        elif mm is None:
+            records = iter(())
+        elif use_pool:
+            records = self._iter_records_parallel(mm, start_offset, max_results, is_known, hold_tail)
+        else:
+            records = self._iter_records(mm, start_offset, max_results, is_known, hold_tail)
+
+        for idx, end, record in records:
+
+            last_end = end
 
-            message_id = message.get("Message-ID", None)
-            if not message_id:
+            if record is None:
+                skipped += 1
                 continue
 
-            if session.query(Email).filter_by(id=message_id).first():
+            if self._save_record(writer, idx, record):
+                self._flush(session, writer, last_end)
+
+        self._flush(session, writer, last_end)
+
+        session.close()
+
+        self.offset = last_end
+
+        print(f"\nAll emails are processed! ({skipped} messages skipped by the prefilter)")
+
+
+    def follow(self, poll_interval=0.5, settle_time=0.5, batch_size=1000):
+        """ Load the mbox and keep loading messages appended to it, handling truncation and rotation. """
+
+        if self.compression:
+            print(f"[WARN] --follow is not supported for compressed mailboxes, loading {self.mbox_path} once")
+            self.load_emails(batch_size=batch_size)
+            return
+
+        watcher = self._watch_mbox()
+
+        if watcher is None:
+            print(f"Following {self.mbox_path} (stat polling every {poll_interval} s)")
+        else:
+            print(f"Following {self.mbox_path} (inotify)")
+
+        held_tail = False
+
+        while True:
+
+            try:
+                stat = os.stat(self.mbox_path)
+            except FileNotFoundError:
+                # rotated away and not recreated yet
+                self._wait_for_change(watcher, poll_interval)
                 continue
 
-            subject = self._decode_header_value(message.get("Subject", ""))
-            sender = self._decode_header_value(message.get("From", ""))
+            changed = stat.st_ino != self.inode or stat.st_size != self.offset
 
-            recipients_raw = message.get_all("To", [])
+            if changed or held_tail:
 
-            recipients = []
-            for r in recipients_raw:
-                decoded = self._decode_header_value(r)
-                _, email = parseaddr(decoded)
-                if email:
-                    recipients.append(email)
+                if stat.st_ino != self.inode and self.inode is not None:
+                    print(f"[INFO] mbox file was replaced, reading it from the start: {self.mbox_path}")
 
-            # Parse date
-            date = message.get("Date")
-            parsed_date = parsedate_to_datetime(date) if date else None
+                elif stat.st_size < self.offset:
+                    print(f"[INFO] mbox file was truncated, reading it from the start: {self.mbox_path}")
 
-            print(f"\n({idx+1}) Processing new mbox email:")
-            print(f"  Date: {date}")
-            print(f"  Subject: {subject}")
-            print(f"  From: {sender}")
+                # a message may still be half written, wait until the file is quiet
+                held_tail = time.time() - stat.st_mtime < settle_time
 
-            references_raw = message.get('References', '')
-            references_list = references_raw.split() if references_raw else []
+                try:
+                    self.load_emails(batch_size=batch_size, hold_tail=held_tail)
+                except FileNotFoundError:
+                    continue
 
-            in_reply_to = self._decode_header_value(message.get("In-Reply-To", ""))
+            self._wait_for_change(watcher, settle_time if held_tail else poll_interval)
 
-            thread_id = self._build_thread_id(message)
-            body = self._get_body(message)
-            attachments = self._get_attachments(message)
 
-            email_obj = Email(
-                id=message_id,
-                thread_id=thread_id,
-                references=references_list,
-                in_reply_to=in_reply_to,
-                sender=sender,
-                recipients=recipients,
-                date=parsed_date or datetime.utcnow(),
-                subject=subject,
-                body=body
-            )
+    def _watch_mbox(self):
 
-            session.add(email_obj)
+        if INotify is None:
+            return None
 
-            for filename, meta in attachments.items():
+        try:
+            # watch the directory so that rotation (new file, rename) is seen as well
+            watcher = INotify()
+            watcher.add_watch(os.path.dirname(os.path.abspath(self.mbox_path)),
+                              inotify_flags.MODIFY | inotify_flags.CREATE | inotify_flags.MOVED_TO | inotify_flags.DELETE)
+            return watcher
+        except OSError as e:
+            print(f"[WARN] inotify is not available, falling back to polling: {e}")
+            return None
 
-                attachment = Attachment(
-                    id=str(uuid.uuid4()),
-                    email_id=message_id,
-                    filename=filename,
-                    mime_type=meta["mime_type"],
-                    extension=meta["extension"],
-                    size=meta["size"],
-                    text_content=meta["text"]
-                )
-                session.add(attachment)
 
-            batch_counter += 1
+    def _wait_for_change(self, watcher, timeout):
 
-            if batch_counter >= batch_size:
-                session.commit()
-                batch_counter = 0
+        if watcher is None:
+            time.sleep(timeout)
+            return
 
-        if batch_counter > 0:
-            session.commit()
+        name = os.path.basename(self.mbox_path)
 
-        session.close()
-        print("\nAll emails are processed!")
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            events = watcher.read(timeout=int(remaining * 1000))
+            if any(event.name == name for event in events):
+                return
 
 
-    def _iter_mbox_stream(self):
+    def _iter_records(self, mm, start_offset, max_results, is_known, hold_tail=False):
 
-        separator = b"From "
+        for idx, (start, end, data) in enumerate(self._iter_mbox_slices(mm, start_offset, hold_tail)): # 78970
 
-        with open(self.mbox_path, "rb") as f:
+            if max_results != -1 and idx >= max_results:
+                break
 
-            buffer = bytearray()
-            first = True
+            message_id = self._prefilter(mm, data, start, end)
+            if not message_id or is_known(message_id):
+                yield idx, end, None
+                continue
 
-            for line in f:
-                if line.startswith(separator):
-                    if not first:
-                        yield message_from_binary_file(io.BytesIO(buffer))
-                    else:
-                        first = False
-                    buffer = bytearray()
-                buffer.extend(line)
+            message = _message_from_view(data)
+            data.release()
 
-            if buffer:
-                yield message_from_binary_file(io.BytesIO(buffer))
+            yield idx, end, self._parse_message(message)
 
 
-    def _decode_header_value(self, value: str) -> str:
+    def _iter_records_parallel(self, mm, start_offset, max_results, is_known, hold_tail=False, ranges_per_task=64):
 
-        try:
-            decoded_parts = decode_header(value)
-            return str(make_header(decoded_parts))
-        except Exception as e:
-            print(f"[WARN] Failed to decode header: {value}\nReason: {e}")
-            return value
+        ranges = list(self._iter_mbox_ranges(mm, start_offset, hold_tail))
+        if max_results != -1:
+            ranges = ranges[:max_results]
 
+        tasks = [ranges[i:i + ranges_per_task] for i in range(0, len(ranges), ranges_per_task)]
 
-    def _build_thread_id(self, message):
+        print(f"Parsing {len(ranges)} mbox messages with {self.workers} workers...")
 
-        references = message.get("References", None)
-        in_reply_to = message.get("In-Reply-To", None)
-        message_id = message.get("Message-ID", None)
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=_init_mbox_worker,
+                                 initargs=(self,)) as executor:
 
-        if references:
-            ref_ids = references.split()
-            thread_id = ref_ids[0]
-        elif in_reply_to:
-            thread_id = in_reply_to
-        else:
-            thread_id = message_id
+            # records are consumed in submission order, so they reach the writer in file order
+            results = self.iter_pool_results(executor, _parse_mbox_ranges, tasks, self.workers * 2)
 
-        return thread_id
+            idx = 0
 
+            for task_ranges, records in results:
+                for (_, end), record in zip(task_ranges, records):
+                    if record is not None and is_known(record["id"]):
+                        record = None
+                    yield idx, end, record
+                    idx += 1
 
-    def _get_body(self, message) -> str:
-        """ Extract plain text body from the email. """
 
-        plain_text = ""
-        html_text = ""
+    def _iter_stream_records(self, start_offset, max_results, is_known, messages_per_task=64):
 
-        if message.is_multipart():
+        with self._open_stream() as stream:
 
-            for part in message.walk():
+            messages = self._iter_stream_messages(stream, start_offset)
+            if max_results != -1:
+                messages = itertools.islice(messages, max_results)
 
-                content_type = part.get_content_type()
-                content_disposition = str(part.get("Content-Disposition", "")).lower()
+            if self.workers == 1:
 
-                if "attachment" in content_disposition:
-                    continue  # Skip attachments
+                for idx, (_, end, data) in enumerate(messages):
 
-                try:
-                    payload = part.get_payload(decode=True)
-                    if not payload:
+                    message_id = self._prefilter(data, data, 0, len(data))
+                    if not message_id or is_known(message_id):
+                        yield idx, end, None
                         continue
 
-                    charset = part.get_content_charset() or "utf-8"
-                    text = payload.decode(charset, errors="ignore")
+                    yield idx, end, self._parse_message(_message_from_view(data))
 
-                    if content_type == "text/plain":
-                        plain_text += text
-                    elif content_type == "text/html":
-                        html_text += text
+                return
+
+            # the decompressed bytes have to be shipped to the workers, there is no shared mapping
+            tasks = iter(lambda: list(itertools.islice(messages, messages_per_task)), [])
+
+            print(f"Parsing {self.compression} compressed mbox messages with {self.workers} workers...")
+
+            with ProcessPoolExecutor(max_workers=self.workers,
+                                     initializer=_init_mbox_worker,
+                                     initargs=(self,)) as executor:
+
+                results = self.iter_pool_results(executor, _parse_mbox_messages, tasks, self.workers * 2)
+
+                idx = 0
+
+                for task_messages, records in results:
+                    for (_, end, _), record in zip(task_messages, records):
+                        if record is not None and is_known(record["id"]):
+                            record = None
+                        yield idx, end, record
+                        idx += 1
+
+
+    @contextmanager
+    def _open_stream(self):
+
+        if self.compression == "gzip":
+            with gzip.open(self.mbox_path, "rb") as stream:
+                yield stream
+
+        elif self.compression == "xz":
+            with lzma.open(self.mbox_path, "rb") as stream:
+                yield stream
+
+        elif self.compression == "zstd":
+            with open(self.mbox_path, "rb") as f:
+                with zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True) as stream:
+                    yield stream
+
+        elif self.compression == "zip":
+            with zipfile.ZipFile(self.mbox_path) as zip_file:
+                member = self._find_zip_mbox(zip_file)
+                with zip_file.open(member) as stream:
+                    yield stream
 
-                except Exception:
-                    continue
         else:
+            raise ValueError(f"unsupported compression: {self.compression}")
 
-            try:
-                payload = message.get_payload(decode=True)
-                if payload:
-                    charset = message.get_content_charset() or "utf-8"
-                    text = payload.decode(charset, errors="ignore")
-                    content_type = message.get_content_type()
-                    if content_type == "text/plain":
-                        plain_text = text
-                    elif content_type == "text/html":
-                        html_text = text
-            except Exception:
-                pass
 
-        if html_text:
-            status, output = self.html_to_text(html_text)
-            if status and output:
-                plain_text = output
+    def _find_zip_mbox(self, zip_file):
 
-        return plain_text.replace('\x00', '').strip()
+        # a Google Takeout archive holds one or more .mbox files, "All mail" is the largest
+        members = [info for info in zip_file.infolist() if info.filename.lower().endswith(".mbox")]
+        if not members:
+            raise ValueError(f"no .mbox file found in {self.mbox_path}")
 
+        member = max(members, key=lambda info: info.file_size)
+        print(f"Reading '{member.filename}' from {self.mbox_path}")
 
-    def _get_attachments(self, message) -> dict:
+        return member
 
-        attachments = {}
 
-        if not message.is_multipart():
-            return attachments
+    def _iter_stream_messages(self, stream, start_offset=0, chunk_size=4*1024*1024):
+        """ Same as _iter_mbox_ranges(), for a non-seekable stream. Yields (start, end, message bytes). """
 
-        for part in message.walk():
+        separator = b"\nFrom "
 
-            content_disposition = str(part.get("Content-Disposition", ""))
+        # skip what was committed before, decompressing without parsing
+        skipped = 0
+        while skipped < start_offset:
+            data = stream.read(min(chunk_size, start_offset - skipped))
+            if not data:
+                return
+            skipped += len(data)
 
-            if "attachment" in content_disposition:
+        buffer = bytearray()
+        base = start_offset     # stream offset of buffer[0]
+        msg_start = 0 if start_offset else None
+        scan_from = 0
 
-                filename = part.get_filename()
-                if not filename:
-                    continue
+        while True:
 
-                try:
-                    binary_data = part.get_payload(decode=True) or b""
-                    mime_type = part.get_content_type()
-                    effective_mime = self.get_mime_type(mime_type, filename, binary_data)
-                    text_data = self.extract_text(effective_mime, binary_data)
-                    attachments[filename] = {
-                        "mime_type": effective_mime,
-                        "extension": self.get_file_extension(filename),
-                        "size": len(binary_data),
-                        "text": text_data,
-                    }
-                except Exception:
-                    continue
+            chunk = stream.read(chunk_size)
+            buffer += chunk
+
+            # anything before the first "From " line is not part of a message
+            if msg_start is None:
+                if buffer[:5] == b"From ":
+                    msg_start = 0
+                else:
+                    pos = buffer.find(separator)
+                    if pos != -1:
+                        msg_start = pos + 1
+
+            if msg_start is not None:
+
+                while True:
+                    pos = buffer.find(separator, max(msg_start, scan_from))
+                    if pos == -1:
+                        break
+                    end = pos + 1
+                    yield base + msg_start, base + end, bytes(buffer[msg_start:end])
+                    msg_start = end
+
+                # drop consumed bytes and resume the search near the end of the buffer
+                del buffer[:msg_start]
+                base += msg_start
+                msg_start = 0
+                scan_from = max(0, len(buffer) - len(separator) + 1)
+
+            if not chunk:
+                break
+
+        if msg_start is None:
+            msg_start = 0
+
+        if len(buffer) > msg_start:
+            yield base + msg_start, base + len(buffer), bytes(buffer[msg_start:])
+
+
+    def _prefilter(self, mm, data, start, end):
+        """ Parse only the headers of a message and return its Message-ID if it still needs a full parse. """
+
+        header_end = mm.find(b"\n\n", start, end)
+        header_end_crlf = mm.find(b"\n\r\n", start, end)
+        if header_end == -1 or (header_end_crlf != -1 and header_end_crlf < header_end):
+            header_end = header_end_crlf
+        header_end = end if header_end == -1 else header_end + 1
+
+        headers = HeaderParser().parsestr(_decode_view(data[:header_end - start]))
+
+        return self._check_headers(headers)
+
+
+    def _map_mbox(self):
+
+        with open(self.mbox_path, "rb") as f:
+
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+
+            # the mapping stays valid after the file object is closed
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def _iter_mbox_ranges(self, mm, start_offset=0, hold_tail=False):
+
+        separator = b"\nFrom "
+        size = len(mm)
+
+        if start_offset >= size:
+            return
+
+        start = start_offset
+
+        # anything before the first "From " line is not part of a message
+        if start == 0 and mm[:5] != b"From ":
+            pos = mm.find(separator)
+            if pos == -1:
+                if not hold_tail:
+                    yield 0, size
+                return
+            start = pos + 1
+
+        while start < size:
+            pos = mm.find(separator, start)
+            end = size if pos == -1 else pos + 1
+            # the last message may still be being appended to
+            if hold_tail and end == size:
+                return
+            yield start, end
+            start = end
+
+
+    def _iter_mbox_slices(self, mm, start_offset=0, hold_tail=False):
+
+        view = memoryview(mm)
+
+        for start, end in self._iter_mbox_ranges(mm, start_offset, hold_tail):
+            yield start, end, view[start:end]
+
+
+    def _get_checkpoint_key(self):
+
+        key = os.path.abspath(self.mbox_path)
+
+        # messages skipped by a filter are behind the offset, so a filtered run must not move the unfiltered checkpoint
+        filters = [f"{name}={value}" for name, value in (("since", self.since), ("until", self.until), ("from", self.from_filter)) if value]
+        if filters:
+            key += "?" + "&".join(filters)
+
+        return key
+
+
+    def _load_checkpoint(self, session, mm):
+
+        self.inode = os.stat(self.mbox_path).st_ino
+
+        checkpoint = session.get(MboxCheckpoint, self.checkpoint_key)
+        if not checkpoint or not checkpoint.offset:
+            return 0
+
+        size = len(mm) if mm is not None else 0
+
+        if checkpoint.inode and checkpoint.inode != self.inode:
+            print(f"[WARN] mbox file was replaced since the last checkpoint, starting from the beginning: {self.mbox_path}")
+            return 0
+
+        if size < checkpoint.size or size < checkpoint.offset:
+            print(f"[WARN] mbox file is smaller than at the last checkpoint, starting from the beginning: {self.mbox_path}")
+            return 0
+
+        if checkpoint.offset < size and mm[checkpoint.offset - 1:checkpoint.offset + 5] != b"\nFrom ":
+            print(f"[WARN] mbox checkpoint at byte {checkpoint.offset} is not a message boundary, starting from the beginning: {self.mbox_path}")
+            return 0
+
+        print(f"Resuming mbox import at byte {checkpoint.offset} of {size}")
+
+        return checkpoint.offset
+
+
+    def _load_stream_checkpoint(self, session):
+
+        stat = os.stat(self.mbox_path)
+        self.inode = stat.st_ino
+
+        checkpoint = session.get(MboxCheckpoint, self.checkpoint_key)
+        if not checkpoint or not checkpoint.offset:
+            return 0
+
+        # an archive is rewritten as a whole, so any change means a new file
+        if checkpoint.size != stat.st_size or checkpoint.mtime != stat.st_mtime:
+            print(f"[WARN] compressed mailbox changed since the last checkpoint, starting from the beginning: {self.mbox_path}")
+            return 0
+
+        print(f"Resuming mbox import at decompressed byte {checkpoint.offset}")
+
+        return checkpoint.offset
+
+
+    def _save_checkpoint(self, session, offset):
+
+        stat = os.stat(self.mbox_path)
+
+        session.merge(MboxCheckpoint(
+            path=self.checkpoint_key,
+            size=stat.st_size,
+            mtime=stat.st_mtime,
+            inode=stat.st_ino,
+            offset=offset,
+            updated_at=datetime.utcnow()
+        ))
+
+
+    def _save_record(self, writer, idx, record):
+
+        print(f"\n({idx+1}) Processing new mbox email:")
+        print(f"  Date: {record['date_header']}")
+        print(f"  Subject: {record['subject']}")
+        print(f"  From: {record['sender']}")
+
+        email_row, attachment_rows = self.build_rows(record)
+        self.known_ids.add(record["id"])
+
+        return writer.add(email_row, attachment_rows)
+
+
+    def _flush(self, session, writer, offset):
+
+        inserted = writer.flush()
+
+        self._save_checkpoint(session, offset)
+        session.commit()
+
+        if inserted:
+            print(f"\nStored {inserted} new emails (checkpoint at byte {offset}).")
+
+
+#################
+
+# Per-process state of the mbox parser pool
+
+_worker_loader = None
+_worker_mm = None
+_worker_view = None
+
+def _init_mbox_worker(loader):
+
+    global _worker_loader, _worker_mm, _worker_view
+
+    init_parser_worker()
+
+    _worker_loader = loader
+
+    if not loader.compression:
+        _worker_mm = loader._map_mbox()
+        _worker_view = memoryview(_worker_mm)
+
+
+def _parse_mbox_ranges(ranges):
+
+    records = []
+
+    for start, end in ranges:
+
+        data = _worker_view[start:end]
+
+        if not _worker_loader._prefilter(_worker_mm, data, start, end):
+            records.append(None)
+            continue
+
+        message = _message_from_view(data)
+        records.append(_worker_loader._parse_message(message))
+
+    return records
+
+
+def _parse_mbox_messages(messages):
+
+    records = []
+
+    for _, _, data in messages:
+
+        if not _worker_loader._prefilter(data, data, 0, len(data)):
+            records.append(None)
+            continue
+
+        records.append(_worker_loader._parse_message(_message_from_view(data)))
+
+    return records
+
+
+def _decode_view(data):
+
+    # Decode straight out of the mapped buffer, exactly like BytesParser
+    # does, without first copying the message into a bytes object
+    return str(data, "ascii", "surrogateescape")
+
+
+def _message_from_view(data):
 
-        return attachments
+    return message_from_string(_decode_view(data))
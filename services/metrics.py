@@ -0,0 +1,95 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics_registry():
+    """ Process-wide counters and gauges, readable as a dict or in the Prometheus text format. """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.values = {}
+        self.types = {}
+        self.help = {}
+        self.server = None
+
+
+    def set_gauge(self, name, value, help_text=""):
+
+        with self.lock:
+            self.values[name] = value
+            self.types[name] = "gauge"
+            if help_text:
+                self.help[name] = help_text
+
+
+    def inc_counter(self, name, amount=1, help_text=""):
+
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + amount
+            self.types[name] = "counter"
+            if help_text:
+                self.help[name] = help_text
+
+
+    def get(self, name, default=None):
+
+        with self.lock:
+            return self.values.get(name, default)
+
+
+    def snapshot(self):
+
+        with self.lock:
+            return dict(self.values)
+
+
+    def render(self):
+
+        lines = []
+
+        with self.lock:
+            for name in sorted(self.values):
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {self.types[name]}")
+                lines.append(f"{name} {self.values[name]}")
+
+        return "\n".join(lines) + "\n"
+
+
+    def start_http_server(self, port, host="0.0.0.0"):
+        """ Serve render() at /metrics for Prometheus scraping, on a daemon thread. """
+
+        if self.server is not None:
+            return
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"[INFO] Metrics available at http://{host}:{port}/metrics")
+
+
+metrics = Metrics_registry()
@@ -0,0 +1,83 @@
+import time
+import threading
+
+import config
+from services.metrics import metrics
+
+
+class Token_bucket():
+    """ Rate limiter for API quota units: refills at 'rate' units per second up to 'capacity'. """
+
+    def __init__(self, rate, capacity=None, name=None):
+
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.name = name
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def consume(self, units):
+        """ Take 'units' from the bucket, sleeping until they are paid for. Returns the seconds waited. """
+
+        with self.lock:
+
+            self._refill()
+
+            # the units are reserved right away, a charge larger than the bucket leaves a debt that later callers wait out too
+            self.tokens -= units
+            delay = max(0.0, -self.tokens / self.rate)
+            self._export(units)
+
+        time.sleep(delay)
+
+        return delay
+
+
+    def _refill(self):
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def _export(self, units):
+
+        if not self.name:
+            return
+
+        metrics.inc_counter(f"{self.name}_quota_units_total", units, "API quota units consumed")
+        metrics.set_gauge(f"{self.name}_quota_tokens", round(self.tokens, 1), "API quota units left in the token bucket")
+
+
+class Poll_scheduler():
+    """ Delay between polls: the minimum right after new mail, growing exponentially while the mailbox stays quiet. """
+
+    def __init__(self,
+                 min_interval=config.poll_min_interval,
+                 max_interval=config.poll_max_interval,
+                 backoff=config.poll_backoff,
+                 name="gmail"):
+
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.name = name
+        self.interval = min_interval
+
+        metrics.set_gauge(f"{self.name}_poll_interval_seconds", self.interval, "Current delay between polls")
+
+
+    def next_interval(self, new_messages):
+
+        if new_messages:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+
+        metrics.inc_counter(f"{self.name}_polls_total", 1, "Completed polls")
+        metrics.inc_counter(f"{self.name}_new_messages_total", new_messages, "New messages stored by polls")
+        metrics.set_gauge(f"{self.name}_poll_interval_seconds", self.interval, "Current delay between polls")
+
+        return self.interval
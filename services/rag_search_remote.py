@@ -1,7 +1,12 @@
 
+import threading
+
 import config
 from services.rag_search_api import RAG_SEARCH_REST_API_Client
 
+# shared by all embedding workers, bounds the number of concurrent requests to RAG-Search
+in_flight = threading.BoundedSemaphore(config.rag_search_max_in_flight)
+
 #################
 
 llm_info_map = {}
@@ -15,7 +20,8 @@ def get_llm_info(model_name):
 
     rest_obj = RAG_SEARCH_REST_API_Client(url=config.rag_search_url)
 
-    status, output = rest_obj.get_llm_info(model_name)
+    with in_flight:
+        status, output = rest_obj.get_llm_info(model_name)
     if not status:
         return False, output
 
@@ -29,7 +35,8 @@ def llm_chat(question, llm_model, context="", session_id="default", timeout=5*60
 
     rest_obj = RAG_SEARCH_REST_API_Client(url=config.rag_search_url)
 
-    status, output = rest_obj.llm_chat(question, llm_model, context, session_id, timeout)
+    with in_flight:
+        status, output = rest_obj.llm_chat(question, llm_model, context, session_id, timeout)
     if not status:
         return False, output
 
@@ -46,21 +53,24 @@ def load_model(model_list):
 
     rest_obj = RAG_SEARCH_REST_API_Client(url=config.rag_search_url)
 
-    return rest_obj.load_model(model_list)
+    with in_flight:
+        return rest_obj.load_model(model_list)
 
 
 def unload_model(model_name):
 
     rest_obj = RAG_SEARCH_REST_API_Client(url=config.rag_search_url)
 
-    return rest_obj.unload_model(model_name)
+    with in_flight:
+        return rest_obj.unload_model(model_name)
 
 
 def unload_all_models():
 
     rest_obj = RAG_SEARCH_REST_API_Client(url=config.rag_search_url)
 
-    return rest_obj.unload_all_models()
+    with in_flight:
+        return rest_obj.unload_all_models()
 
 #################
 
@@ -75,7 +85,8 @@ def get_max_tokens(embed_model):
 
     rest_obj = RAG_SEARCH_REST_API_Client(url=config.rag_search_url)
 
-    status, output = rest_obj.get_max_tokens(embed_model)
+    with in_flight:
+        status, output = rest_obj.get_max_tokens(embed_model)
     if not status:
         return False, output
 
@@ -89,7 +100,8 @@ def split_document(text, chunk_size=1000, separators=None):
 
     rest_obj = RAG_SEARCH_REST_API_Client(url=config.rag_search_url)
 
-    return rest_obj.split_document(text, chunk_size, separators)
+    with in_flight:
+        return rest_obj.split_document(text, chunk_size, separators)
 
 #################
 
@@ -97,7 +109,8 @@ def create_collection(collection_name, embed_model):
 
     rest_obj = RAG_SEARCH_REST_API_Client(url=config.rag_search_url)
 
-    return rest_obj.create_collection(collection_name, embed_model)
+    with in_flight:
+        return rest_obj.create_collection(collection_name, embed_model)
 
 #################
 
@@ -105,12 +118,22 @@ def remove_embed_email_thread(collection_name, thread_id):
 
     rest_obj = RAG_SEARCH_REST_API_Client(url=config.rag_search_url)
 
-    return rest_obj.delete_by_filter(collection_name, {"metadata.thread_id": thread_id})
+    with in_flight:
+        return rest_obj.delete_by_filter(collection_name, {"metadata.thread_id": thread_id})
+
+
+def remove_embed_email(collection_name, thread_id, email_id):
+
+    rest_obj = RAG_SEARCH_REST_API_Client(url=config.rag_search_url)
+
+    with in_flight:
+        return rest_obj.delete_by_filter(collection_name, {"metadata.thread_id": thread_id, "metadata.email_id": email_id})
 
 
 def embed_email_thread(text_block, collection_name, embed_model, metadata={}, separators=None, chunk_size=None, timeout=5*60):
 
     rest_obj = RAG_SEARCH_REST_API_Client(url=config.rag_search_url)
 
-    return rest_obj.embed_email_thread(text_block, collection_name, embed_model, metadata, separators, chunk_size, timeout)
+    with in_flight:
+        return rest_obj.embed_email_thread(text_block, collection_name, embed_model, metadata, separators, chunk_size, timeout)
 
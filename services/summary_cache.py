@@ -0,0 +1,81 @@
+import json
+import hashlib
+import threading
+from datetime import datetime
+
+from sqlalchemy.dialects.postgresql import insert
+from db.session import SessionLocal
+from db.models import SummaryCache
+from services.metrics import metrics
+
+
+class Summary_cache():
+    """ LLM summaries keyed by SHA-256 of the prompt and input text, the LLM model and the prompt version. """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def content_hash(self, prompt, text):
+
+        key = json.dumps([prompt, text])
+        return hashlib.sha256(key.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+    def get(self, content_hash, llm_model, prompt_version):
+
+        session = SessionLocal()
+        try:
+            row = session.get(SummaryCache, (content_hash, llm_model, prompt_version))
+        except Exception as e:
+            print(f"[WARN] summary cache lookup failed: {e}")
+            row = None
+        finally:
+            session.close()
+
+        self._export(row is not None)
+
+        return row.summary if row else None
+
+
+    def put(self, content_hash, llm_model, prompt_version, summary):
+
+        session = SessionLocal()
+        try:
+            stmt = insert(SummaryCache).values(
+                content_hash=content_hash,
+                llm_model=llm_model,
+                prompt_version=prompt_version,
+                summary=summary,
+                created_at=datetime.utcnow()
+            ).on_conflict_do_nothing()
+            session.execute(stmt)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"[WARN] summary cache store failed: {e}")
+        finally:
+            session.close()
+
+
+    def _export(self, hit):
+
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            hit_ratio = self.hits / (self.hits + self.misses)
+
+        if hit:
+            metrics.inc_counter("summary_cache_hits_total", 1, "LLM summaries served from the summary cache")
+        else:
+            metrics.inc_counter("summary_cache_misses_total", 1, "LLM summaries not found in the summary cache")
+
+        metrics.set_gauge("summary_cache_hit_ratio", round(hit_ratio, 4), "Fraction of summary lookups answered by the summary cache")
+
+
+summary_cache = Summary_cache()
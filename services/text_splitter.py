@@ -0,0 +1,138 @@
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import config
+
+
+class Text_splitter():
+    """ In-process equivalent of LangChain's RecursiveCharacterTextSplitter (separators kept at the start
+    of the following piece, whitespace stripped), with an LRU cache of results keyed by SHA-256. """
+
+    def __init__(self, max_entries=256):
+
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def split(self, text, chunk_size, separators=None, chunk_overlap=None):
+
+        separators = separators or ["\n\n", "\n", " ", ""]
+
+        if chunk_overlap is None:
+            chunk_overlap = config.split_chunk_overlap
+
+        # the overlap can never exceed the chunk itself
+        chunk_overlap = min(chunk_overlap, chunk_size)
+
+        key = hashlib.sha256(
+            json.dumps([text, chunk_size, chunk_overlap, separators]).encode("utf-8", errors="surrogatepass")
+        ).hexdigest()
+
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return list(self.memory[key])
+            self.misses += 1
+
+        chunks = self._split_text(text, separators, chunk_size, chunk_overlap)
+
+        with self.lock:
+            self.memory[key] = chunks
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+        return list(chunks)
+
+
+    def _split_text(self, text, separators, chunk_size, chunk_overlap):
+
+        final_chunks = []
+
+        # the first separator that occurs in the text, the rest are used for pieces that are still too long
+        separator = separators[-1]
+        new_separators = []
+
+        for i, s in enumerate(separators):
+            if not s:
+                separator = s
+                break
+            if s in text:
+                separator = s
+                new_separators = separators[i + 1:]
+                break
+
+        good_splits = []
+
+        for s in self._split_keep_separator(text, separator):
+
+            if len(s) < chunk_size:
+                good_splits.append(s)
+                continue
+
+            if good_splits:
+                final_chunks.extend(self._merge_splits(good_splits, chunk_size, chunk_overlap))
+                good_splits = []
+
+            if not new_separators:
+                final_chunks.append(s)
+            else:
+                final_chunks.extend(self._split_text(s, new_separators, chunk_size, chunk_overlap))
+
+        if good_splits:
+            final_chunks.extend(self._merge_splits(good_splits, chunk_size, chunk_overlap))
+
+        return final_chunks
+
+
+    def _split_keep_separator(self, text, separator):
+
+        if not separator:
+            return list(text)
+
+        parts = re.split(f"({re.escape(separator)})", text)
+
+        # every separator starts the piece that follows it
+        splits = [parts[0]] + [parts[i] + parts[i + 1] for i in range(1, len(parts) - 1, 2)]
+
+        return [s for s in splits if s]
+
+
+    def _merge_splits(self, splits, chunk_size, chunk_overlap):
+
+        docs = []
+        current_doc = []
+        total = 0
+
+        for d in splits:
+
+            length = len(d)
+
+            if total + length > chunk_size and current_doc:
+
+                doc = "".join(current_doc).strip()
+                if doc:
+                    docs.append(doc)
+
+                # keep a tail of the previous chunk as overlap, as long as the next piece still fits
+                while total > chunk_overlap or (total + length > chunk_size and total > 0):
+                    total -= len(current_doc[0])
+                    current_doc = current_doc[1:]
+
+            current_doc.append(d)
+            total += length
+
+        doc = "".join(current_doc).strip()
+        if doc:
+            docs.append(doc)
+
+        return docs
+
+
+text_splitter = Text_splitter()
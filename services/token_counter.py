@@ -0,0 +1,90 @@
+import os
+import math
+import threading
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+import config
+
+
+class Token_counter():
+    """ Token counts from a model's own tokenizer (a local tokenizer.json listed in config.tokenizer_files),
+    falling back to config.avg_chars_per_token characters per token for models without one. """
+
+    def __init__(self):
+
+        self.tokenizers = {}
+        self.lock = threading.Lock()
+
+
+    def get_tokenizer(self, model):
+        """ Loaded once per model. Returns None when no usable tokenizer file is configured. """
+
+        with self.lock:
+
+            if model in self.tokenizers:
+                return self.tokenizers[model]
+
+            tokenizer = None
+            path = config.tokenizer_files.get(model)
+
+            # relative paths are relative to the repository, next to config.py
+            if path and not os.path.isabs(path):
+                path = os.path.join(os.path.dirname(os.path.abspath(config.__file__)), path)
+
+            if path and Tokenizer is None:
+                print(f"[WARN] The tokenizers package is required to read {path}, using {config.avg_chars_per_token} characters per token for {model}")
+            elif path and not os.path.isfile(path):
+                print(f"[WARN] Tokenizer file {path} of {model} not found (see download_tokenizers.py), using {config.avg_chars_per_token} characters per token")
+            elif path:
+                try:
+                    tokenizer = Tokenizer.from_file(path)
+                except Exception as e:
+                    print(f"[WARN] Cannot load tokenizer file {path} of {model}: {e}")
+
+            self.tokenizers[model] = tokenizer
+
+            return tokenizer
+
+
+    def tokenizer_id(self, model):
+        """ The tokenizer file used for the model, None when tokens are estimated from characters. """
+
+        if self.get_tokenizer(model) is None:
+            return None
+
+        return config.tokenizer_files.get(model)
+
+
+    def count(self, text, model):
+
+        tokenizer = self.get_tokenizer(model)
+        if tokenizer is None:
+            return math.ceil(len(text) / config.avg_chars_per_token)
+
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+    def special_tokens(self, model):
+        """ Tokens the model adds around every input, such as [CLS] and [SEP]. """
+
+        tokenizer = self.get_tokenizer(model)
+        if tokenizer is None:
+            return 0
+
+        return len(tokenizer.encode("", add_special_tokens=True).ids)
+
+
+    def chars_per_token(self, model, text=""):
+        """ Characters per token of 'text' with the model's tokenizer, the configured average otherwise. """
+
+        if not text or self.get_tokenizer(model) is None:
+            return config.avg_chars_per_token
+
+        return len(text) / max(1, self.count(text, model))
+
+
+token_counter = Token_counter()